@@ -16,7 +16,40 @@
 """The BiosecurID Signature Global Features database
 """
 
-from .query import Database
-from .models import Client, File, Protocol, ProtocolPurpose
+import sys
 
-__all__ = dir()
+# the names exported by this package, and the module defining each of them
+_exports = {
+    'Database': 'query',
+    'Client': 'models',
+    'File': 'models',
+    'Protocol': 'models',
+    'ProtocolPurpose': 'models',
+    'ClientRecord': 'models',
+    'FileRecord': 'models',
+    'ProtocolRecord': 'models',
+    'AsyncDatabase': 'aio',
+    }
+
+if sys.version_info >= (3, 7):
+  # the modules (and SQLAlchemy, numpy...) are only imported on first use
+  def __getattr__(name):
+    if name not in _exports:
+      raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+    import importlib
+    value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+    globals()[name] = value
+    return value
+
+  def __dir__():
+    return sorted(set(globals()) | set(_exports))
+
+else:
+  from .query import Database
+  from .models import Client, File, Protocol, ProtocolPurpose, ClientRecord, FileRecord, ProtocolRecord
+  if sys.version_info[0] >= 3:
+    from .aio import AsyncDatabase
+  else:
+    del _exports['AsyncDatabase'] # asyncio is not available
+
+__all__ = sorted(_exports)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""An asyncio interface to the BiosecurID Signature Global Features database
+(Python 3 only).
+"""
+
+import asyncio
+import threading
+import concurrent.futures
+
+from .query import Database
+from .cache import QueryCache
+from .models import File, Client, FileRecord, ClientRecord
+
+class AsyncDatabase(object):
+  """Runs the queries of :py:class:`.query.Database` on a small pool of
+  threads, so that they do not block the event loop. The methods take the
+  same parameters as the ones of :py:class:`.query.Database` and return
+  awaitables.
+
+  Each thread opens its own :py:class:`.query.Database`, so that the pool
+  holds at most ``workers`` connections. They all share the same
+  :py:class:`.cache.QueryCache` (and the in-memory snapshot, if
+  ``snapshot=True`` is given), which are also available to the synchronous
+  API. When an awaiting task is cancelled, the query it is running is
+  interrupted.
+
+  The mapped objects of a thread cannot be used by another one, so the
+  results are always returned as :py:class:`.FileRecord` and
+  :py:class:`.ClientRecord` objects (:py:meth:`objects`, :py:meth:`clients`
+  and :py:meth:`models` are queried with ``lightweight=True``).
+
+  Keyword Parameters:
+
+  workers
+    The number of threads (and connections) running the queries.
+
+  cache
+    The :py:class:`.cache.QueryCache` of the queries. By default, a new one
+    is created; give one to share it with other (synchronous) objects, or
+    None to disable it.
+
+  The other keyword parameters are passed to :py:class:`.query.Database`.
+  """
+
+  def __init__(self, workers=2, cache=True, **kwargs):
+    if cache is True:
+      cache = QueryCache()
+    self.m_kwargs = dict(kwargs, cache=cache)
+    self.m_workers = workers
+    self.m_local = threading.local()
+    self.m_executor = concurrent.futures.ThreadPoolExecutor(workers)
+
+  def __database__(self):
+    """Returns the :py:class:`.query.Database` of the current thread"""
+
+    db = getattr(self.m_local, 'database', None)
+    if db is None:
+      db = self.m_local.database = Database(**self.m_kwargs)
+    return db
+
+  def __submit__(self, method, *args, **kwargs):
+    """Runs the given method of :py:class:`.query.Database` on the pool,
+    returning an asyncio future of its result"""
+
+    lock = threading.Lock()
+    running = {}
+
+    def run():
+      db = self.__database__()
+      with lock:
+        if 'cancelled' in running:
+          raise concurrent.futures.CancelledError()
+        if db.m_session is not None:
+          running['connection'] = db.m_session.connection().connection
+      try:
+        return records(getattr(db, method)(*args, **kwargs))
+      except Exception:
+        if 'cancelled' in running and db.m_session is not None:
+          db.m_session.rollback()
+        raise
+      finally:
+        with lock:
+          running.pop('connection', None)
+
+    def interrupt(future):
+      if future.cancelled():
+        with lock:
+          running['cancelled'] = True
+          if 'connection' in running:
+            running['connection'].interrupt()
+
+    future = asyncio.get_running_loop().run_in_executor(self.m_executor, run)
+    future.add_done_callback(interrupt)
+    return future
+
+  def objects(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.objects`"""
+    return self.__submit__('objects', *args, **dict(kwargs, lightweight=True))
+
+  def clients(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.clients`"""
+    return self.__submit__('clients', *args, **dict(kwargs, lightweight=True))
+
+  def models(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.models`"""
+    return self.__submit__('models', *args, **dict(kwargs, lightweight=True))
+
+  def model_ids(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.model_ids`"""
+    return self.__submit__('model_ids', *args, **kwargs)
+
+  def client(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.client`"""
+    return self.__submit__('client', *args, **kwargs)
+
+  def files(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.files`"""
+    return self.__submit__('files', *args, **kwargs)
+
+  def reverse(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.reverse`"""
+    return self.__submit__('reverse', *args, **kwargs)
+
+  def paths(self, *args, **kwargs):
+    """See :py:meth:`.query.Database.paths`"""
+    return self.__submit__('paths', *args, **kwargs)
+
+  def close(self):
+    """Closes the sessions of the threads of the pool and stops them, after
+    the queries in progress"""
+
+    # one task per thread: each one waits for the others, so that they all
+    # run on different threads and close the session of their own thread
+    barrier = threading.Barrier(self.m_workers)
+    def close():
+      barrier.wait()
+      db = getattr(self.m_local, 'database', None)
+      if db is not None and db.m_session is not None:
+        db.m_session.close()
+      self.m_local.database = None
+    closing = [self.m_executor.submit(close) for k in range(self.m_workers)]
+    concurrent.futures.wait(closing)
+    self.m_executor.shutdown(wait=True)
+
+
+def records(value):
+  """Converts the mapped :py:class:`.File` and :py:class:`.Client` objects
+  in the given result (a single object or a sequence) into records, which do
+  not depend on the session of the thread that queried them"""
+
+  if isinstance(value, File):
+    return FileRecord(value.id, value.client_id, value.path, value.session_id, value.shot_id)
+  if isinstance(value, Client):
+    return ClientRecord(value.id, value.subid, value.sgroup, value.stype)
+  if isinstance(value, (list, tuple)) and any(isinstance(k, (File, Client)) for k in value):
+    return [records(k) for k in value]
+  return value
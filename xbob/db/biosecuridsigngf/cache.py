@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""A cache of query results with least-recently-used eviction.
+"""
+
+import collections
+import threading
+
+class QueryCache(object):
+  """Memoizes the results of the queries of :py:class:`.query.Database`,
+  keyed by their (checked and normalized) parameters.
+
+  At most ``maxsize`` results are kept; the least recently used one is
+  evicted first. All results are dropped when :py:meth:`validate` is given a
+  different modification time of the SQLite file. The cache can be shared by
+  several threads.
+  """
+
+  def __init__(self, maxsize=128):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.m_items = collections.OrderedDict()
+    self.m_mtime = None
+    self.m_lock = threading.Lock()
+
+  def validate(self, mtime):
+    """Clears the cache if the given modification time of the SQLite file
+    differs from the one of the cached results"""
+
+    with self.m_lock:
+      if mtime != self.m_mtime:
+        self.m_items.clear()
+        self.m_mtime = mtime
+
+  def get(self, key):
+    """Returns a tuple (found, value) for the given key"""
+
+    with self.m_lock:
+      if key in self.m_items:
+        value = self.m_items.pop(key)
+        self.m_items[key] = value # most recently used
+        self.hits += 1
+        return True, value
+      self.misses += 1
+      return False, None
+
+  def put(self, key, value):
+    """Stores the value for the given key, evicting the least recently used
+    one if the cache is full"""
+
+    with self.m_lock:
+      self.m_items.pop(key, None)
+      self.m_items[key] = value
+      while len(self.m_items) > self.maxsize:
+        self.m_items.popitem(last=False)
+
+  def clear(self):
+    """Drops all cached results and resets the statistics"""
+
+    with self.m_lock:
+      self.m_items.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def info(self):
+    """Returns a dictionary with the number of hits and misses, the number of
+    cached results and the maximum size"""
+
+    with self.m_lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self.m_items), 'maxsize': self.maxsize}
@@ -16,8 +16,14 @@
 """This script creates the BiosecurId database in a single pass.
 """
 
-import os,string
+import os
+import re
+import sys
+import posixpath
+import threading
+from six.moves import queue
 
+from sqlalchemy import select, literal, func
 from .models import *
 
 # clients
@@ -29,48 +35,152 @@ def nodot(item):
   """Can be used to ignore hidden files, starting with the . character."""
   return item[0] != '.'
 
-def add_clients(session, verbose):
+# pragmas for a one-shot build of a new file: no rollback journal, no fsync,
+# large cache
+BULK_PRAGMAS = ('journal_mode = OFF', 'synchronous = OFF', 'cache_size = -65536', 'temp_store = MEMORY')
+
+def add_clients(connection, verbose):
   """Add clients to the  Biosecure DS2 Signature Global Features database."""
   users_list = (userid_training, userid_eval_clients, userid_eval_impostors)
   group_choices = ('world', 'clientEval','impostorEval')
-  
+
+  rows = []
   for g, group in enumerate(group_choices):
     for ctype in ['genuine', 'skilled']:
       for cdid in users_list[g]:
-        cid = ctype + '_%d' % cdid
-        if verbose>1: print("  Adding user '%s' of type '%s' group '%s'..." % (cid, ctype, g))
-        session.add(Client(cid, ctype, cdid, group))
-
-
-def add_files(session, imagedir, verbose):
-  """Add files to the Biosecure DS2 Signature Global Features database."""
-
-  def add_file(session, basename, userid, shotid, sessionid):
-    """Parse a single filename and add it to the list."""
-    session.add(File(userid, basename, sessionid, shotid))
-
-  filenames = os.listdir(imagedir)
-  for filename in filenames:
-    basename, extension = os.path.splitext(filename)
-    if extension == db_file_extension:
-      if verbose>1: print("  Adding file '%s'..." % (basename))
-      parts = string.split(basename, "_")
-      ctype = parts[2]
-      shotid = int(parts[1])
-      userid = ctype + '_%d' % int(parts[0])
-      if shotid <= 7:
-        sessionid = 1
-      elif shotid <= 14:
-        sessionid = 2
-      elif shotid <= 21:
-        sessionid = 3
-      elif shotid <= 28:
-        sessionid = 4
-      add_file(session, basename, userid, shotid, sessionid)
-
-
-def add_protocols(session, verbose):
-  """Adds protocols"""
+        cid = Client.make_id(ctype, cdid)
+        if verbose>1: print("  Adding user '%s_%d' of type '%s' group '%s'..." % (ctype, cdid, ctype, g))
+        rows.append({'id': cid, 'stype': ctype, 'subid': cdid, 'sgroup': group})
+  connection.execute(Client.__table__.insert(), rows)
+
+
+# the basenames of the feature files, e.g. '51_8_skilled'
+FILENAME = re.compile(r'^(\d+)_(\d+)_(%s)$' % '|'.join(Client.type_choices))
+
+def parse_filename(basename):
+  """Parses the basename of a feature file (e.g. '51_8_skilled'), returning
+  the client id, the session id and the shot id. Returns None if the basename
+  does not follow the naming of the database."""
+
+  match = FILENAME.match(basename)
+  if match is None:
+    return None
+  ctype = match.group(3)
+  shotid = int(match.group(2))
+  userid = Client.make_id(ctype, int(match.group(1)))
+  # 7 shots per session
+  sessionid = (shotid - 1) // 7 + 1
+  return userid, sessionid, shotid
+
+
+def list_directory(imagedir, directory):
+  """Lists one directory of the image directory, given relative to it.
+  Returns its subdirectories and the paths (without extension) of its
+  feature files, both relative to the image directory."""
+
+  subdirectories, files = [], []
+  absolute = os.path.join(imagedir, directory)
+  if hasattr(os, 'scandir'):
+    entries = [(k.name, k.is_dir()) for k in os.scandir(absolute)]
+  else: # python 2
+    entries = [(k, os.path.isdir(os.path.join(absolute, k))) for k in os.listdir(absolute)]
+  for name, is_dir in entries:
+    if not nodot(name): continue
+    path = posixpath.join(directory, name)
+    if is_dir:
+      subdirectories.append(path)
+    else:
+      basename, extension = os.path.splitext(path)
+      if extension == db_file_extension:
+        files.append(basename)
+  return sorted(subdirectories), sorted(files)
+
+
+def walk(imagedir):
+  """Walks the image directory and its subdirectories, yielding the relative
+  path of each directory with the list of its feature files (see
+  :py:func:`list_directory`)."""
+
+  pending = ['']
+  while pending:
+    directory = pending.pop()
+    subdirectories, files = list_directory(imagedir, directory)
+    pending.extend(reversed(subdirectories))
+    yield directory, files
+
+
+def file_rows(paths, verbose):
+  """Returns the rows of the file table for the given feature files,
+  skipping the ones whose name cannot be parsed."""
+
+  rows = []
+  for path in paths:
+    parsed = parse_filename(posixpath.basename(path))
+    if parsed is None:
+      if verbose: print("  Ignoring file '%s'..." % (path))
+      continue
+    if verbose>1: print("  Adding file '%s'..." % (path))
+    userid, sessionid, shotid = parsed
+    rows.append({'client_id': userid, 'path': path, 'session_id': sessionid, 'shot_id': shotid})
+  return rows
+
+
+def add_files(connection, imagedir, verbose, batch_size=1000, queue_size=8):
+  """Add files to the Biosecure DS2 Signature Global Features database.
+
+  The image directory is walked and the filenames are parsed by a separate
+  thread, which passes batches of rows to the bulk inserter through a bounded
+  queue, so that the memory does not depend on the number of files. Returns
+  the directories that were walked."""
+
+  batches = queue.Queue(queue_size)
+  directories = []
+  # set when the inserter fails, so that the scanner stops instead of
+  # waiting forever for room in the queue
+  stop = threading.Event()
+
+  def put(item):
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def scan():
+    try:
+      for directory, files in walk(imagedir):
+        directories.append(directory)
+        for paths in chunks(files, batch_size):
+          rows = file_rows(paths, verbose)
+          if rows and not put(rows): return
+    except Exception as e:
+      put(e)
+    put(None)
+
+  scanner = threading.Thread(target=scan)
+  scanner.daemon = True
+  scanner.start()
+  try:
+    while True:
+      rows = batches.get()
+      if rows is None: break
+      if isinstance(rows, Exception): raise rows
+      connection.execute(File.__table__.insert(), rows)
+  except:
+    stop.set()
+    scanner.join()
+    raise
+  scanner.join()
+  return directories
+
+
+def protocol_purposes():
+  """Returns the definition of the protocols, as a list of (protocol name,
+  purposes), where each purpose is a tuple (group, purpose, selection) and the
+  selection is the condition on the File and Client tables that the files
+  attached to the purpose fulfill."""
 
   # 1. DEFINITIONS
   enroll_shots = [1, 2, 6, 7]
@@ -79,55 +189,153 @@ def add_protocols(session, verbose):
   random_impostor_probe_shots = [1]
   protocols = ['skilledImpostors', 'randomImpostors']
 
+  # the files of each protocol purpose
+  world = and_(Client.sgroup == 'world', Client.stype == 'genuine')
+  enrol = and_(Client.sgroup == 'clientEval', Client.stype == 'genuine', File.shot_id.in_(enroll_shots))
+  client_probe = and_(Client.sgroup == 'clientEval', Client.stype == 'genuine', File.shot_id.in_(client_probe_shots))
+  impostor_probe = {
+    'skilledImpostors': and_(Client.sgroup == 'clientEval', Client.stype == 'skilled', File.shot_id.in_(skilled_impostor_probe_shots)),
+    'randomImpostors': and_(Client.sgroup == 'impostorEval', Client.stype == 'genuine', File.shot_id.in_(random_impostor_probe_shots)),
+    }
+
+  return [(proto, [
+      ('world', 'train', world),
+      ('eval', 'enrol', enrol),
+      ('eval', 'probe', or_(client_probe, impostor_probe[proto])),
+    ]) for proto in protocols]
+
+
+def attach_files(connection, purpose_id, selection, first_file_id=None):
+  """Attaches the files fulfilling the given selection to a protocol
+  purpose, in the database. If first_file_id is given, only the files with
+  this id or a larger one are considered."""
+
+  if first_file_id is not None:
+    selection = and_(selection, File.id >= first_file_id)
+  files = select([literal(purpose_id), File.id]).\
+      select_from(File.__table__.join(Client.__table__)).where(selection)
+  connection.execute(protocolPurpose_file_association.insert().\
+      from_select(['protocolPurpose_id', 'file_id'], files))
+
+
+def add_protocols(connection, verbose):
+  """Adds protocols"""
+
   # 2. ADDITIONS TO THE SQL DATABASE
-  protocolPurpose_list = [('world', 'train'), ('eval', 'enrol'), ('eval', 'probe')]
-  for proto in protocols:
-    p = Protocol(proto)
-    # Add protocol
+  for proto, purposes in protocol_purposes():
     if verbose: print("Adding protocol %s..." % (proto))
-    session.add(p)
-    session.flush()
-    session.refresh(p)
-    if verbose: print("Adding protocol %s..." % (proto))
-    
+    protocol_id = connection.execute(Protocol.__table__.insert(), {'name': proto}).inserted_primary_key[0]
+
     # Add protocol purposes
-    for key in range(len(protocolPurpose_list)):
-      purpose = protocolPurpose_list[key]
-      print p.id, purpose[0], purpose[1]
-      pu = ProtocolPurpose(p.id, purpose[0], purpose[1])
-      if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (purpose[0], purpose[1]))
-      session.add(pu)
-      session.flush()
-      session.refresh(pu)
+    for sgroup, purpose, selection in purposes:
+      if verbose>1: print("  Adding protocol purpose ('%s','%s')..." % (sgroup, purpose))
+      purpose_id = connection.execute(ProtocolPurpose.__table__.insert(),
+          {'protocol_id': protocol_id, 'sgroup': sgroup, 'purpose': purpose}).inserted_primary_key[0]
 
       # Add files attached with this protocol purpose
-      if(key == 0): # world
-        q = session.query(File).join(Client).filter(and_(Client.sgroup == 'world', Client.stype == 'genuine'))
-        for k in q:
-          if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-          pu.files.append(k)
-      
-      elif(key == 1): #test enrol
-        q = session.query(File).join(Client).filter(and_(Client.sgroup == 'clientEval', Client.stype == 'genuine')).filter(File.shot_id.in_(enroll_shots))
-        for k in q:
-          if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-          pu.files.append(k)
-
-      elif(key == 2): #test probe
-        q = session.query(File).join(Client).filter(and_(Client.sgroup == 'clientEval', Client.stype == 'genuine')).filter(File.shot_id.in_(client_probe_shots))
-        for k in q:
-          if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-          pu.files.append(k)
-        if(proto == 'skilledImpostors'): 
-          q = session.query(File).join(Client).filter(and_(Client.sgroup == 'clientEval', Client.stype == 'skilled')).filter(File.shot_id.in_(skilled_impostor_probe_shots))
-          for k in q:
-            if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-            pu.files.append(k)
-        elif(proto == 'randomImpostors'):
-          q = session.query(File).join(Client).filter(and_(Client.sgroup == 'impostorEval', Client.stype == 'genuine')).filter(File.shot_id.in_(random_impostor_probe_shots))
-          for k in q:
-            if verbose>1: print("    Adding protocol file '%s'..." % (k.path))
-            pu.files.append(k)
+      attach_files(connection, purpose_id, selection)
+
+
+def chunks(sequence, size=500):
+  """Splits a sequence in chunks of the given size (by default, small enough
+  to keep the IN (...) clauses within the limits of SQLite)"""
+
+  sequence = list(sequence)
+  return [sequence[k:k+size] for k in range(0, len(sequence), size)]
+
+
+def directory_changed(imagedir, directory, recorded):
+  """Tells if the size or modification time of a directory (relative to the
+  image directory) differ from the recorded ones, or if it was removed"""
+
+  try:
+    stat = os.stat(os.path.join(imagedir, directory))
+  except OSError:
+    return True
+  return tuple(recorded) != (stat.st_size, stat.st_mtime)
+
+
+def record_directories(connection, imagedir, directories):
+  """Records the current size and modification time of the given directories
+  (relative to the image directory) in the manifest, and forgets the ones
+  which do not exist anymore"""
+
+  rows = []
+  for directory in directories:
+    absolute = os.path.join(imagedir, directory)
+    if os.path.isdir(absolute):
+      stat = os.stat(absolute)
+      rows.append({'path': directory, 'size': stat.st_size, 'mtime': stat.st_mtime})
+  for paths in chunks(directories):
+    connection.execute(directory_manifest.delete().where(directory_manifest.c.path.in_(paths)))
+  if rows:
+    connection.execute(directory_manifest.insert(), rows)
+
+
+def update_files(connection, imagedir, verbose):
+  """Updates an existing database with the files added to or removed from
+  the image directory since it was created (or last updated). Only the
+  directories whose size or modification time changed according to the
+  manifest, and the new directories they contain, are listed."""
+
+  m = directory_manifest.c
+  recorded = dict((path, (size, mtime)) for path, size, mtime in connection.execute(select([m.path, m.size, m.mtime])))
+  changed = [k for k in recorded if directory_changed(imagedir, k, recorded[k])]
+  if recorded and not changed:
+    if verbose: print("Directory '%s' did not change" % imagedir)
+    return
+  unchanged = set(recorded) - set(changed)
+
+  existing = {}
+  for path, file_id in connection.execute(select([File.path, File.id])):
+    existing.setdefault(posixpath.dirname(path), {})[path] = file_id
+
+  # lists the changed directories and the new ones they contain
+  vanished, new, listed = set(), [], set()
+  pending = changed if recorded else ['']
+  while pending:
+    directory = pending.pop()
+    listed.add(directory)
+    if not os.path.isdir(os.path.join(imagedir, directory)):
+      # the directory was removed, with its files and subdirectories
+      for k, known in existing.items():
+        if k == directory or k.startswith(directory + '/'):
+          vanished.update(known.values())
+      continue
+    subdirectories, files = list_directory(imagedir, directory)
+    pending.extend(k for k in subdirectories if k not in recorded and k not in listed)
+    known = existing.get(directory, {})
+    vanished.update(known[k] for k in set(known) - set(files))
+    new.extend(k for k in files if k not in known)
+
+  # the files of the directories which were neither listed nor unchanged are gone
+  for directory, known in existing.items():
+    if directory not in listed and directory not in unchanged:
+      vanished.update(known.values())
+
+  # removes the vanished files, with their protocol purposes
+  for ids in chunks(sorted(vanished)):
+    connection.execute(protocolPurpose_file_association.delete().\
+        where(protocolPurpose_file_association.c.file_id.in_(ids)))
+    connection.execute(File.__table__.delete().where(File.id.in_(ids)))
+  if verbose: print("Removed %d files" % len(vanished))
+
+  # adds the new files; they get larger ids than the existing ones
+  rows = file_rows(new, verbose)
+  if rows:
+    first_file_id = (connection.execute(select([func.max(File.id)])).scalar() or 0) + 1
+    connection.execute(File.__table__.insert(), rows)
+
+    # attaches the new files to the protocol purposes
+    q = select([ProtocolPurpose.id, Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose]).\
+        select_from(ProtocolPurpose.__table__.join(Protocol.__table__))
+    purpose_ids = dict(((name, sgroup, purpose), k) for k, name, sgroup, purpose in connection.execute(q))
+    for proto, purposes in protocol_purposes():
+      for sgroup, purpose, selection in purposes:
+        attach_files(connection, purpose_ids[(proto, sgroup, purpose)], selection, first_file_id)
+  if verbose: print("Added %d files" % len(rows))
+
+  record_directories(connection, imagedir, sorted(listed))
 
 
 def create_tables(args):
@@ -143,7 +351,7 @@ def create_tables(args):
 def create(args):
   """Creates or re-creates this database"""
 
-  from bob.db.utils import session_try_nolock
+  from bob.db.utils import create_engine_try_nolock
 
   dbfile = args.files[0]
 
@@ -155,22 +363,55 @@ def create(args):
   if not os.path.exists(os.path.dirname(dbfile)):
     os.makedirs(os.path.dirname(dbfile))
 
-  # the real work...
-  create_tables(args)
-  s = session_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
-  add_clients(s, args.verbose)
-  add_files(s, args.imagedir, args.verbose)
-  add_protocols(s, args.verbose)
-  s.commit()
-  s.close()
-
-def add_command(subparsers):
-  """Add specific subcommands that the action "create" can use"""
-
-  parser = subparsers.add_parser('create', help=create.__doc__)
+  if args.update and os.path.exists(dbfile):
+    # creates the tables which were added since the database was built
+    create_tables(args)
+    engine = create_engine_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
+    connection = engine.connect()
+    try:
+      transaction = connection.begin()
+      try:
+        update_files(connection, args.imagedir, args.verbose)
+        transaction.commit()
+      except:
+        transaction.rollback()
+        raise
+    finally:
+      connection.close()
+    return
 
-  parser.add_argument('-R', '--recreate', action='store_true', help="If set, I'll first erase the current database")
-  parser.add_argument('-v', '--verbose', action='count', help="Do SQL operations in a verbose way?")
-  parser.add_argument('-D', '--imagedir', metavar='DIR', default='/home/bob/BioSecure_DS2_Sign_GlobalFeats', help="Change the relative path to the directory containing the images of the Biosecure DS2 Global Features database.")
+  if os.path.exists(dbfile):
+    # the full build below drops the indexes, which cannot be rolled back
+    sys.stderr.write("Database '%s' already exists: use --recreate to build it again or --update to update it\n" % dbfile)
+    return 1
 
-  parser.set_defaults(func=create) #action
+  # the real work...
+  create_tables(args)
+  engine = create_engine_try_nolock(args.type, dbfile, echo=(args.verbose > 2))
+  connection = engine.connect()
+  try:
+    # the file is new, so it is built without rollback journal: the pragmas
+    # must be set outside of a transaction, and the file is removed on failure
+    # instead of being rolled back
+    for pragma in BULK_PRAGMAS:
+      connection.execute('PRAGMA %s' % pragma)
+    transaction = connection.begin()
+    # the indexes are built once all rows are loaded
+    indexes = [k for table in Base.metadata.sorted_tables for k in table.indexes]
+    for index in indexes:
+      index.drop(connection)
+    add_clients(connection, args.verbose)
+    directories = add_files(connection, args.imagedir, args.verbose)
+    add_protocols(connection, args.verbose)
+    record_directories(connection, args.imagedir, directories)
+    for index in indexes:
+      index.create(connection)
+    connection.execute('ANALYZE')
+    transaction.commit()
+  except:
+    connection.close()
+    engine.dispose()
+    if os.path.exists(dbfile): os.unlink(dbfile)
+    raise
+  finally:
+    connection.close()
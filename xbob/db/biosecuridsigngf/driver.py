@@ -18,29 +18,98 @@
 
 import os
 import sys
+import time
+import itertools
+import six
 from bob.db.driver import Interface as BaseInterface
 
+# The values accepted by the options of the commands. They are the constants
+# defined in the models module, which is not imported here so that building
+# the command line parser does not load SQLAlchemy nor query the database.
+# The protocols and model ids, which are stored in the database, are only
+# checked when the command runs.
+CHOICES = {
+    'purpose': ('enrol', 'probe'),
+    'group': ('eval',),
+    'class': ('client', 'skilledImpostor', 'randomImpostor'),
+    }
+
+# the output formats of dumplist
+FORMATS = ('lines', 'null', 'jsonl', 'csv')
+
+def create(args):
+  """Creates or re-creates this database"""
+
+  from .create import create as create_database
+  return create_database(args)
+
 def dumplist(args):
   """Dumps lists of files based on your criteria"""
 
   from .query import Database
   db = Database()
 
-  r = db.objects(
+  if args.client is not None and args.client not in db.model_ids():
+    sys.stderr.write('Invalid model id %d\n' % args.client)
+    return 1
+
+  selection = dict(
       protocol=args.protocol,
       purposes=args.purpose,
-      model_ids=(args.client,),
+      model_ids=(args.client,) if args.client is not None else None,
       groups=args.group,
-      classes=args.sclass
-  )
+      classes=args.sclass,
+      shard=args.shard,
+      shard_by=args.shard_by,
+      )
+  try:
+    rows = db.object_rows(batch_size=args.batch_size, **selection)
+    first = list(itertools.islice(rows, 1)) # raises on invalid parameters
+  except ValueError as e:
+    sys.stderr.write('%s\n' % e)
+    return 1
 
   output = sys.stdout
   if args.selftest:
     from bob.db.utils import null
     output = null()
 
-  for f in r:
-    output.write('%s\n' % (f.make_path(args.directory, args.extension),))
+  if args.format == 'jsonl':
+    import json
+    def format_row(f, client, purpose, sclass):
+      return json.dumps({'id': f.id, 'path': f.make_path(args.directory, args.extension),
+        'client': client, 'session': f.session_id, 'shot': f.shot_id,
+        'purpose': purpose, 'class': sclass}, sort_keys=True) + '\n'
+  elif args.format == 'csv':
+    import csv
+    buffer = six.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    def csv_row(*row):
+      buffer.seek(0)
+      buffer.truncate()
+      writer.writerow(row)
+      return buffer.getvalue()
+    output.write(csv_row('id', 'path', 'client', 'session', 'shot', 'purpose', 'class'))
+    def format_row(f, client, purpose, sclass):
+      return csv_row(f.id, f.make_path(args.directory, args.extension), client,
+          f.session_id, f.shot_id, purpose or '', sclass or '')
+  else:
+    separator = '\0' if args.format == 'null' else '\n'
+    last = [None]
+    def format_row(f, client, purpose, sclass):
+      # a file with several purposes comes in consecutive rows, listed once
+      if f.id == last[0]:
+        return ''
+      last[0] = f.id
+      return f.make_path(args.directory, args.extension) + separator
+
+  # writes the output in large blocks, instead of once per file
+  rows = itertools.chain(first, rows)
+  while True:
+    block = [format_row(*row) for row in itertools.islice(rows, args.batch_size)]
+    if not block:
+      break
+    output.write(''.join(block))
 
   return 0
 
@@ -50,16 +119,35 @@ def checkfiles(args):
   from .query import Database
   db = Database()
 
-  r = db.objects()
+  start = time.time()
+  r = db.objects(lightweight=True)
+  paths = [f.make_path(args.directory, args.extension) for f in r]
 
   # go through all files, check if they are available on the filesystem
-  good = []
-  bad = []
-  for f in r:
-    if os.path.exists(f.make_path(args.directory, args.extension)):
-      good.append(f)
-    else:
-      bad.append(f)
+  if args.listdir:
+    # list each directory once, instead of checking each file
+    listings = {}
+    def exists(path):
+      directory, name = os.path.split(path)
+      if directory not in listings:
+        try:
+          listings[directory] = set(os.listdir(directory or '.'))
+        except OSError:
+          listings[directory] = set()
+      return name in listings[directory]
+    found = [exists(k) for k in paths]
+  elif args.jobs > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(args.jobs)
+    try:
+      found = pool.map(os.path.exists, paths, chunksize=64)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    found = [os.path.exists(k) for k in paths]
+  bad = [p for p, ok in zip(paths, found) if not ok]
+  elapsed = time.time() - start
 
   # report
   output = sys.stdout
@@ -68,13 +156,37 @@ def checkfiles(args):
     output = null()
 
   if bad:
-    for f in bad:
-      output.write('Cannot find file "%s"\n' % (f.make_path(args.directory, args.extension),))
+    for path in bad:
+      output.write('Cannot find file "%s"\n' % (path,))
     output.write('%d files (out of %d) were not found at "%s"\n' % \
       (len(bad), len(r), args.directory))
 
+  if args.verbose:
+    output.write('Checked %d files in %.2f seconds (%.0f files per second)\n' % \
+      (len(paths), elapsed, len(paths) / max(elapsed, 1e-9)))
+
   return 0
 
+def read_arguments(values, filename, convert=str):
+  """Returns the given values, followed by the ones read from the given file
+  (one per line, blank lines are skipped). '-' reads them from stdin."""
+
+  values = [convert(k) for k in values or ()]
+  if filename is not None:
+    stream = sys.stdin if filename == '-' else open(filename)
+    try:
+      values.extend(convert(k.strip()) for k in stream if k.strip())
+    finally:
+      if stream is not sys.stdin: stream.close()
+  return values
+
+def report_missing(what, missing, total):
+  """Writes the keys (ids or paths) which were not found to stderr"""
+
+  if missing:
+    sys.stderr.write('%d %s(s) (out of %d) not found: %s\n' % \
+        (len(missing), what, total, ', '.join(str(k) for k in missing)))
+
 def reverse(args):
   """Returns a list of file database identifiers given the path stems"""
 
@@ -86,8 +198,12 @@ def reverse(args):
     from bob.db.utils import null
     output = null()
 
-  r = db.reverse(args.path)
-  for f in r: output.write('%d\n' % f.id)
+  paths = read_arguments(args.path, args.input)
+  r = db.reverse(paths, ignore_missing=True)
+  output.write(''.join('%d\n' % f.id for f in r))
+
+  found = set(f.path for f in r)
+  report_missing('path', [k for k in paths if k not in found], len(paths))
 
   if not r: return 1
 
@@ -104,8 +220,13 @@ def path(args):
     from bob.db.utils import null
     output = null()
 
-  r = db.paths(args.id, prefix=args.directory, suffix=args.extension)
-  for path in r: output.write('%s\n' % path)
+  ids = read_arguments(args.id, args.input, int)
+  files = db.files(ids, ignore_missing=True)
+  r = [f.make_path(args.directory, args.extension) for f in files]
+  output.write(''.join('%s\n' % path for path in r))
+
+  found = set(f.id for f in files)
+  report_missing('id', [k for k in ids if k not in found], len(ids))
 
   if not r: return 1
 
@@ -137,23 +258,29 @@ class Interface(BaseInterface):
     subparsers = self.setup_parser(parser,
         " BiosecurID Signature Global Features database", docs)
 
-    # example: get the "create" action from a submodule
-    from .create import add_command as create_command
-    create_command(subparsers)
-
-    from .query import Database
     import argparse
-    db = Database()
+
+    # the "create" action, whose module (and SQLAlchemy) is only imported to run it
+    parser = subparsers.add_parser('create', help=create.__doc__)
+    parser.add_argument('-R', '--recreate', action='store_true', help="If set, I'll first erase the current database")
+    parser.add_argument('-U', '--update', action='store_true', help="If set, I'll only add the files which are new in the image directory to the current database and remove the ones which are gone")
+    parser.add_argument('-v', '--verbose', action='count', default=0, help="Do SQL operations in a verbose way?")
+    parser.add_argument('-D', '--imagedir', metavar='DIR', default='/home/bob/BioSecure_DS2_Sign_GlobalFeats', help="Change the relative path to the directory containing the images of the Biosecure DS2 Global Features database.")
+    parser.set_defaults(func=create) #action
 
     # example: get the "dumplist" action from a submodule
     parser = subparsers.add_parser('dumplist', help=dumplist.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
-    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol.", choices=db.protocol_names() if db.is_valid() else ())
-    parser.add_argument('-u', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes.", choices=db.purposes() if db.is_valid() else ())
-    parser.add_argument('-C', '--client', type=int, help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=db.model_ids() if db.is_valid() else ())
-    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=db.groups() if db.is_valid() else ())
-    parser.add_argument('-c', '--class', dest="sclass", help="if given, this value will limit the output files to those belonging to the given classes.", choices=('client', 'impostor', ''))
+    parser.add_argument('-p', '--protocol', help="if given, limits the dump to a particular subset of the data that corresponds to the given protocol.", )
+    parser.add_argument('-u', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes.", choices=CHOICES['purpose'])
+    parser.add_argument('-C', '--client', type=int, help="if given, this value will limit the output files to those belonging to a particular protocolar group.")
+    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=CHOICES['group'])
+    parser.add_argument('-c', '--class', dest="sclass", help="if given, this value will limit the output files to those belonging to the given classes.", choices=CHOICES['class'])
+    parser.add_argument('-s', '--shard', help="if given as 'k/N', only dumps the k-th of N disjoint shards of the files (k counted from 1), e.g. to split the work between N machines.")
+    parser.add_argument('-S', '--shard-by', dest="shard_by", default='file', choices=('file', 'client'), help="if 'client', all files of a model are kept in the same shard; by default, the files are spread by id.")
+    parser.add_argument('-f', '--format', default='lines', choices=FORMATS, help="the output format: one path per line (the default), NUL-separated paths (for 'xargs -0'), or one JSON object or CSV row per file with its id, client, session, shot, purpose and class.")
+    parser.add_argument('-b', '--batch-size', dest="batch_size", type=int, default=4096, help="the number of files fetched from the database and written to the output at once.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=dumplist) #action
 
@@ -161,12 +288,16 @@ class Interface(BaseInterface):
     parser = subparsers.add_parser('checkfiles', help=checkfiles.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="if given, the files are checked by this number of threads in parallel.")
+    parser.add_argument('-l', '--listdir', action='store_true', help="if set, each directory is listed once and the files are looked up in the listing, instead of checking each file.")
+    parser.add_argument('-v', '--verbose', action='store_true', help="if set, reports the number of files checked per second.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=checkfiles) #action
 
     # adds the "reverse" command
     parser = subparsers.add_parser('reverse', help=reverse.__doc__)
-    parser.add_argument('path', nargs='+', type=str, help="one or more path stems to look up. If you provide more than one, files which cannot be reversed will be omitted from the output.")
+    parser.add_argument('path', nargs='*', type=str, help="one or more path stems to look up. The files which cannot be reversed are omitted from the output and listed in an error message. The exit status will be non-zero if none of them is found.")
+    parser.add_argument('-i', '--input', help="if given, the path stems are also read from this file, one per line ('-' reads them from the standard input).")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=reverse) #action
 
@@ -174,7 +305,8 @@ class Interface(BaseInterface):
     parser = subparsers.add_parser('path', help=path.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
-    parser.add_argument('id', nargs='+', type=int, help="one or more file ids to look up. If you provide more than one, files which cannot be found will be omitted from the output. If you provide a single id to lookup, an error message will be printed if the id does not exist in the database. The exit status will be non-zero in such case.")
+    parser.add_argument('-i', '--input', help="if given, the file ids are also read from this file, one per line ('-' reads them from the standard input).")
+    parser.add_argument('id', nargs='*', type=int, help="one or more file ids to look up. The ids which cannot be found are omitted from the output and listed in an error message. The exit status will be non-zero if none of them is found.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=path) #action
 
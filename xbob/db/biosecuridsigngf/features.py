@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Loading of the global features of the signatures, which are stored as one
+text file per signature.
+"""
+
+import os
+import numpy
+import multiprocessing
+
+def parse(filename):
+  """Reads the feature vector stored in the given text file, as a 1D array of
+  floats. The values may be separated by any whitespace."""
+
+  with open(filename) as f:
+    return numpy.fromstring(f.read(), dtype=numpy.float64, sep=' ')
+
+def parse_batch(filenames):
+  """Reads the feature vectors of the given text files into a 2D array, one
+  row per file. Raises a ValueError if the files have different lengths."""
+
+  vectors = [parse(k) for k in filenames]
+  for filename, vector in zip(filenames, vectors):
+    if len(vector) != len(vectors[0]):
+      raise ValueError("File '%s' has %d features, but '%s' has %d" % \
+          (filename, len(vector), filenames[0], len(vectors[0])))
+  return numpy.vstack(vectors)
+
+def load(files, directory, extension, jobs=None, batch_size=256):
+  """Reads the features of the given files into a single matrix.
+
+  Keyword Parameters:
+
+  files
+    The :py:class:`.File` (or :py:class:`.FileRecord`) objects to read.
+
+  directory, extension
+    The directory and extension of the feature files, see
+    :py:meth:`.File.make_path`.
+
+  jobs
+    The number of processes parsing the files in parallel. If 'None' is
+    given (this is the default), one process per CPU is used. With 1, the
+    files are parsed in the current process.
+
+  batch_size
+    The number of files parsed at once by each process.
+
+  Returns: A tuple ``(ids, features)``, where ``features`` is a contiguous
+  2D float array with one row per file and ``ids`` holds the :py:class:`.File`
+  id of each row. If no file is given, the number of features is unknown and
+  ``features`` has the shape ``(0, 0)``.
+  """
+
+  files = list(files)
+  ids = numpy.array([f.id for f in files], dtype=numpy.int32)
+  paths = [f.make_path(directory, extension) for f in files]
+  return ids, parse_all(paths, jobs, batch_size)
+
+def parse_all(filenames, jobs=None, batch_size=256):
+  """Reads the feature vectors of the given text files into a contiguous 2D
+  array, parsing batches of files in parallel (see :py:func:`load`)."""
+
+  batches = [filenames[k:k+batch_size] for k in range(0, len(filenames), batch_size)]
+
+  if jobs == 1 or len(batches) <= 1:
+    blocks = [parse_batch(k) for k in batches]
+  else:
+    pool = multiprocessing.Pool(jobs)
+    try:
+      blocks = pool.map(parse_batch, batches)
+    finally:
+      pool.close()
+      pool.join()
+
+  if not blocks:
+    return numpy.empty((0, 0), dtype=numpy.float64)
+  for k, block in enumerate(blocks):
+    if block.shape[1] != blocks[0].shape[1]:
+      raise ValueError("File '%s' has %d features, but '%s' has %d" % \
+          (batches[k][0], block.shape[1], batches[0][0], blocks[0].shape[1]))
+  return numpy.ascontiguousarray(numpy.vstack(blocks))
+
+
+class FeatureCache(object):
+  """A binary cache of the features of the whole corpus.
+
+  The cache is a single ``.npy`` file, which is opened read-only with
+  :py:func:`numpy.load` and ``mmap_mode='r'``, so that all processes of a
+  machine share the same pages without copying or parsing anything. Each row
+  holds the :py:class:`.File` id, the size and modification time of the text
+  file it was parsed from, and the features. When the cache is updated, only
+  the rows of new or modified files are parsed again, and a new file is
+  renamed over the former one, which is never modified in place: the readers
+  always see the ids and the features of the same version.
+
+  Keyword Parameters:
+
+  filename
+    The name of the cache, without extension.
+  """
+
+  def __init__(self, filename):
+    self.m_filename = filename + '.npy'
+
+  @staticmethod
+  def dtype(width):
+    """The type of the rows of a cache of the given number of features"""
+
+    return numpy.dtype([('id', numpy.int32), ('size', numpy.int64),
+      ('mtime', numpy.float64), ('features', numpy.float64, (width,))])
+
+  def is_valid(self):
+    """Tells if the cache has been built"""
+
+    return os.path.exists(self.m_filename)
+
+  def __load__(self):
+    """Loads the rows of the cache read-only, memory-mapped"""
+
+    try:
+      return numpy.load(self.m_filename, mmap_mode='r')
+    except ValueError:
+      # an empty cache may not be mapped
+      rows = numpy.load(self.m_filename)
+      rows.flags.writeable = False
+      return rows
+
+  def update(self, files, directory, extension, jobs=None, batch_size=256):
+    """Builds the cache for the given files, or refreshes it: the rows of
+    files whose size and modification time did not change are kept, the
+    others are parsed from the text files (see :py:func:`load` for the
+    parameters).
+
+    Returns: The number of files that were parsed.
+    """
+
+    files = list(files)
+    ids = numpy.array([f.id for f in files], dtype=numpy.int32)
+    paths = [f.make_path(directory, extension) for f in files]
+    stats = [os.stat(k) for k in paths]
+    sizes = numpy.array([k.st_size for k in stats], dtype=numpy.int64)
+    mtimes = numpy.array([k.st_mtime for k in stats], dtype=numpy.float64)
+
+    # the row of each file in the current cache, -1 if it must be parsed
+    reuse = numpy.repeat(-1, len(files))
+    old = self.__load__() if self.is_valid() else None
+    if old is not None:
+      rows = dict((i, k) for k, i in enumerate(old['id']))
+      for k, i in enumerate(ids):
+        r = rows.get(i, -1)
+        if r >= 0 and old['size'][r] == sizes[k] and old['mtime'][r] == mtimes[k]:
+          reuse[k] = r
+      same_layout = numpy.array_equal(old['id'], ids)
+      old_width = old.dtype['features'].shape[0]
+    else:
+      same_layout = False
+
+    stale = numpy.flatnonzero(reuse < 0)
+    kept = numpy.flatnonzero(reuse >= 0)
+    if not len(stale) and same_layout:
+      return 0
+    parsed = parse_all([paths[k] for k in stale], jobs, batch_size)
+
+    if len(stale):
+      width = parsed.shape[1]
+    else:
+      width = old_width if old is not None else 0
+    if len(kept) and width != old_width:
+      raise ValueError("The files in '%s' have %d features, but the cache has %d; remove it to rebuild it" % \
+          (directory, width, old_width))
+
+    # a new file is written and renamed over the current one, so that the
+    # processes which have the current one mapped keep reading it unchanged
+    temporary = self.m_filename + '.tmp.npy'
+    if not len(files):
+      numpy.save(temporary, numpy.zeros(0, dtype=self.dtype(width)))
+      os.rename(temporary, self.m_filename)
+      return 0
+    matrix = numpy.lib.format.open_memmap(temporary, mode='w+', dtype=self.dtype(width), shape=(len(files),))
+    matrix['id'] = ids
+    matrix['size'] = sizes
+    matrix['mtime'] = mtimes
+    if len(kept):
+      matrix['features'][kept] = old['features'][reuse[kept]]
+    if len(stale):
+      matrix['features'][stale] = parsed
+    matrix.flush()
+    del matrix, old
+    os.rename(temporary, self.m_filename)
+    return len(stale)
+
+  def open(self):
+    """Opens the cache read-only.
+
+    Returns: A tuple ``(ids, features)``, where ``features`` is a read-only
+    memory-mapped 2D array (a strided view of the rows of the cache) and
+    ``ids`` holds the :py:class:`.File` id of each row.
+    """
+
+    rows = self.__load__()
+    return rows['id'], rows['features']
+
+  def rows(self, ids):
+    """Returns the rows of the cache holding the features of the given
+    :py:class:`.File` ids, raises a KeyError if one is not cached"""
+
+    rows = dict((i, k) for k, i in enumerate(self.__load__()['id']))
+    return numpy.array([rows[i] for i in ids], dtype=numpy.int64)
@@ -16,9 +16,10 @@
 """Table models and functionality for the BiosecurId database.
 """
 
-import os, numpy
+import os, numpy, six
 import bob.db.utils
-from sqlalchemy import Table, Column, Integer, String, ForeignKey, or_, and_, not_
+from sqlalchemy import Table, Column, Index, Integer, SmallInteger, Float, String, ForeignKey, or_, and_, not_
+from sqlalchemy.types import TypeDecorator
 from bob.db.sqlalchemy_migration import Enum, relationship
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
@@ -27,44 +28,120 @@ import xbob.db.verification.utils
 
 Base = declarative_base()
 
+class EnumCode(TypeDecorator):
+  """An enumeration stored as a small integer, the index of the value in the
+  given choices. The values are converted when they are bound and loaded, so
+  that the columns can be compared with the strings themselves."""
+
+  impl = SmallInteger
+  cache_ok = True
+
+  def __init__(self, *choices):
+    TypeDecorator.__init__(self)
+    self.choices = tuple(choices)
+
+  def process_bind_param(self, value, dialect):
+    if value is None: return None
+    return self.choices.index(value)
+
+  def process_result_value(self, value, dialect):
+    if value is None: return None
+    return self.choices[value]
+
 protocolPurpose_file_association = Table('protocolPurpose_file_association', Base.metadata,
-  Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
-  Column('file_id',  Integer, ForeignKey('file.id')))
+  Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id'), primary_key=True),
+  Column('file_id',  Integer, ForeignKey('file.id'), primary_key=True),
+  # for the joins starting from the files
+  Index('ix_protocolPurpose_file_association_file', 'file_id', 'protocolPurpose_id'))
+
+# the directories indexed by the create command, with their size and
+# modification time, to detect changes when the database is updated
+directory_manifest = Table('directory_manifest', Base.metadata,
+  Column('path', String(255), primary_key=True),
+  Column('size', Integer),
+  Column('mtime', Float))
 
 db_file_extension = '.txt'
 
+# the classes (types of accesses) of the probe files
+class_choices = ('client', 'skilledImpostor', 'randomImpostor')
+
+# the layout of the arrays returned by Database.objects_array()
+objects_array_dtype = numpy.dtype([
+  ('id', numpy.int32),
+  ('subid', numpy.int32),
+  ('stype', numpy.int8),
+  ('sgroup', numpy.int8),
+  ('session_id', numpy.int8),
+  ('shot_id', numpy.int8),
+  ('purpose', numpy.int8),
+  ('sclass', numpy.int8),
+  ])
+
 class Client(Base):
   """Database clients, marked by an integer identifier and the group they belong to"""
 
   __tablename__ = 'client'
+  __table_args__ = (
+    Index('ix_client_sgroup_stype_subid', 'sgroup', 'stype', 'subid'),
+    Index('ix_client_subid', 'subid'),
+    )
 
-  # Key identifier for the client
-  id = Column(String(100), primary_key=True)
+  # Key identifier for the client, see make_id()
+  id = Column(Integer, primary_key=True)
   subid = Column(Integer)
   group_choices = ('world', 'clientEval','impostorEval')
-  sgroup = Column(Enum(*group_choices)) # do NOT use group (SQL keyword)
+  sgroup = Column(EnumCode(*group_choices)) # do NOT use group (SQL keyword)
   type_choices = ('genuine', 'skilled')
-  stype = Column(Enum(*type_choices)) # do NOT use type
+  stype = Column(EnumCode(*type_choices)) # do NOT use type
+
+  # the subject ids are smaller than this value
+  subid_range = 1000
 
   def __init__(self, id, stype, subid, group):
-    self.id = id
+    self.id = Client.to_id(id)
     self.stype = stype
     self.subid = subid
     self.sgroup = group
 
+  @staticmethod
+  def make_id(stype, subid):
+    """Returns the integer id of the client with the given type and subject
+    id, so that the ids sort by type, then by subject id"""
+    return Client.type_choices.index(stype) * Client.subid_range + subid
+
+  @staticmethod
+  def to_id(id):
+    """Converts a string client id (e.g. 'genuine_51', as used by former
+    versions of this database) into the integer id. Integer ids are returned
+    unchanged."""
+    if isinstance(id, six.string_types):
+      stype, subid = id.rsplit('_', 1)
+      return Client.make_id(stype, int(subid))
+    return id
+
+  @property
+  def name(self):
+    """The string id of the client (e.g. 'genuine_51')"""
+    return '%s_%d' % (self.stype, self.subid)
+
   def __repr__(self):
-    return "Client(`%s`, `%s`, `%s`)" % (self.id, self.stype, self.sgroup)
+    return "Client(`%s`, `%s`, `%s`)" % (self.name, self.stype, self.sgroup)
 
 
 class File(Base, xbob.db.verification.utils.File):
   """Generic file container"""
 
   __tablename__ = 'file'
+  # covers the joins with the clients and the sorting of the queries
+  __table_args__ = (
+    Index('ix_file_client_session_shot', 'client_id', 'session_id', 'shot_id', 'id'),
+    )
 
   # Key identifier for the file
   id = Column(Integer, primary_key=True)
   # Key identifier of the client associated with this file
-  client_id = Column(String(100), ForeignKey('client.id')) # for SQL
+  client_id = Column(Integer, ForeignKey('client.id')) # for SQL
   # Unique path to this file inside the database
   path = Column(String(100), unique=True)
   # Session identifier
@@ -77,11 +154,76 @@ class File(Base, xbob.db.verification.utils.File):
 
   def __init__(self, client_id, path, session_id, shot_id):
     # call base class constructor
-    xbob.db.verification.utils.File.__init__(self, client_id = client_id, path = path)
+    xbob.db.verification.utils.File.__init__(self, client_id = Client.to_id(client_id), path = path)
     
     self.session_id = session_id
     self.shot_id = shot_id
 
+  def sort_key(self):
+    """Returns the key the files returned by the queries are sorted with. It
+    can be used to merge several sorted lists of files (e.g., with
+    ``heapq.merge``) without sorting them again."""
+    return (self.client_id, self.session_id, self.shot_id, self.id)
+
+
+class ClientRecord(object):
+  """Lightweight, read-only view of a :py:class:`Client` row, built straight
+  from the query results without the ORM bookkeeping"""
+
+  __slots__ = ('id', 'subid', 'sgroup', 'stype')
+
+  def __init__(self, id, subid, sgroup, stype):
+    self.id = id
+    self.subid = subid
+    self.sgroup = sgroup
+    self.stype = stype
+
+  @staticmethod
+  def columns():
+    """The columns to be queried, in the order of the constructor arguments"""
+    return (Client.id, Client.subid, Client.sgroup, Client.stype)
+
+  @property
+  def name(self):
+    """The string id of the client (e.g. 'genuine_51')"""
+    return '%s_%d' % (self.stype, self.subid)
+
+  def __repr__(self):
+    return "ClientRecord(`%s`, `%s`, `%s`)" % (self.name, self.stype, self.sgroup)
+
+
+class FileRecord(object):
+  """Lightweight, read-only view of a :py:class:`File` row, built straight
+  from the query results without the ORM bookkeeping"""
+
+  __slots__ = ('id', 'client_id', 'path', 'session_id', 'shot_id')
+
+  def __init__(self, id, client_id, path, session_id, shot_id):
+    self.id = id
+    self.client_id = client_id
+    self.path = path
+    self.session_id = session_id
+    self.shot_id = shot_id
+
+  @staticmethod
+  def columns():
+    """The columns to be queried, in the order of the constructor arguments"""
+    return (File.id, File.client_id, File.path, File.session_id, File.shot_id)
+
+  def make_path(self, directory=None, extension=None):
+    """Wraps the current path so that a complete path is formed, exactly like
+    :py:meth:`File.make_path` does"""
+    if not directory: directory = ''
+    if not extension: extension = ''
+    return str(os.path.join(directory, self.path + extension))
+
+  def sort_key(self):
+    """Returns the same sorting key as :py:meth:`File.sort_key`"""
+    return (self.client_id, self.session_id, self.shot_id, self.id)
+
+  def __repr__(self):
+    return "FileRecord('%s')" % (self.path,)
+
 
 class Protocol(Base):
   """ BiosecurID Signature Global Features protocols"""
@@ -100,10 +242,31 @@ class Protocol(Base):
     return "Protocol('%s')" % (self.name,)
 
 
+class ProtocolRecord(object):
+  """Lightweight, read-only view of a :py:class:`Protocol` row"""
+
+  __slots__ = ('id', 'name')
+
+  def __init__(self, id, name):
+    self.id = id
+    self.name = name
+
+  @staticmethod
+  def columns():
+    """The columns to be queried, in the order of the constructor arguments"""
+    return (Protocol.id, Protocol.name)
+
+  def __repr__(self):
+    return "ProtocolRecord('%s')" % (self.name,)
+
+
 class ProtocolPurpose(Base):
   """ BiosecurID Signature Global Features protocol purposes"""
 
   __tablename__ = 'protocolPurpose'
+  __table_args__ = (
+    Index('ix_protocolPurpose_protocol_sgroup_purpose', 'protocol_id', 'sgroup', 'purpose'),
+    )
 
   # Unique identifier for this protocol purpose object
   id = Column(Integer, primary_key=True)
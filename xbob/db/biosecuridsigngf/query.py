@@ -19,25 +19,154 @@
 
 import os
 import six
+import numpy
+try:
+  from collections.abc import Iterable
+except ImportError: # python 2
+  from collections import Iterable
 from bob.db import utils
 from .models import *
-from .driver import Interface
+from .snapshot import pick_files
 
 import xbob.db.verification.utils
 
-SQLITE_FILE = Interface().files()[0]
+SQLITE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db.sql3')
 
 class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.utils.Database):
   """The dataset class opens and maintains a connection opened to the Database.
 
   It provides many different ways to probe for the characteristics of the data
   and for the data itself inside the database.
+
+  If ``snapshot`` is set, the content of the database is loaded once in memory
+  (see :py:mod:`.snapshot`) and :py:meth:`objects`, :py:meth:`clients`,
+  :py:meth:`models`, :py:meth:`model_ids`, :py:meth:`protocols`,
+  :py:meth:`client`, :py:meth:`reverse` and :py:meth:`paths` are answered from
+  it, returning :py:class:`.FileRecord`, :py:class:`.ClientRecord` and
+  :py:class:`.ProtocolRecord` objects. The snapshot is shared by all
+  instances and reloaded when the SQLite file is modified.
+
+  If ``read_only`` is set, the SQLite file is opened through an URI with
+  ``mode=ro&immutable=1`` (Python 3 only), so that SQLite neither takes nor
+  checks any lock, and with memory-mapped I/O of up to ``mmap_size`` bytes.
+  This is meant for many processes reading the file concurrently, which must
+  not modify it in the meantime.
+
+  The connection is re-opened when the object is used in a forked child
+  process (e.g., by a :py:mod:`multiprocessing` pool). Pickling the object
+  only stores its configuration, so that it can be sent to other processes.
+
+  If ``cache`` is set, the results of :py:meth:`objects`, :py:meth:`clients`,
+  :py:meth:`models` and :py:meth:`model_ids` are memoized in a
+  :py:class:`.cache.QueryCache`, keyed by their checked parameters, and
+  returned as tuples shared by all calls. Only records are cached (i.e. with
+  ``lightweight=True`` or in snapshot mode): the mapped objects are bound to
+  the session of the object which queried them. Give ``True`` to use a cache
+  of this object only, or a :py:class:`.cache.QueryCache` to share it between
+  several objects. The cache is cleared when the SQLite file is modified.
   """
 
-  def __init__(self, original_directory = None, original_extension = db_file_extension):
+  # the number of ids or paths looked up by each query of files() and
+  # reverse(), below the limit of 999 parameters of SQLite statements
+  lookup_chunk_size = 500
+
+  def __init__(self, original_directory = None, original_extension = db_file_extension, snapshot = False,
+               read_only = False, mmap_size = 256 * 1024 * 1024, cache = None):
     # call base class constructor
     xbob.db.verification.utils.SQLiteDatabase.__init__(self, SQLITE_FILE, File)
     xbob.db.verification.utils.Database.__init__(self, original_directory=original_directory, original_extension=original_extension)
+    self.m_use_snapshot = snapshot
+    self.m_read_only = read_only
+    self.m_mmap_size = mmap_size
+    self.m_pid = os.getpid()
+    if cache is True:
+      from .cache import QueryCache
+      cache = QueryCache()
+    self.m_cache = cache or None
+    if read_only and self.m_session is not None:
+      self.m_session.close()
+      self.__connect__()
+
+  def __getstate__(self):
+    """Only the configuration is pickled, not the session"""
+
+    return {
+        'original_directory': self.original_directory,
+        'original_extension': self.original_extension,
+        'snapshot': self.m_use_snapshot,
+        'read_only': self.m_read_only,
+        'mmap_size': self.m_mmap_size,
+        'cache': self.m_cache is not None,
+        }
+
+  def __setstate__(self, state):
+    self.__init__(**state)
+
+  def __connect__(self):
+    """(Re-)opens the session on the SQLite file"""
+
+    if not self.m_read_only:
+      xbob.db.verification.utils.SQLiteDatabase.__init__(self, SQLITE_FILE, File)
+      self.m_pid = os.getpid()
+      return
+
+    import sqlite3
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from six.moves.urllib.request import pathname2url
+
+    uri = 'file:%s?mode=ro&immutable=1' % pathname2url(SQLITE_FILE)
+    mmap_size = self.m_mmap_size
+    def connect():
+      connection = sqlite3.connect(uri, uri=True)
+      connection.execute('PRAGMA mmap_size = %d' % mmap_size)
+      return connection
+
+    engine = create_engine('sqlite://', creator=connect)
+    self.m_session = sessionmaker(bind=engine)()
+    self.m_pid = os.getpid()
+
+  def query(self, *args):
+    """Creates a query for the given entities, re-opening the connection
+    first if we are in a forked child process"""
+
+    if self.m_session is not None and self.m_pid != os.getpid():
+      # the session and connection of the parent process are left alone
+      self.__connect__()
+    return xbob.db.verification.utils.SQLiteDatabase.query(self, *args)
+
+  def cache_info(self):
+    """Returns the statistics of the query cache (see
+    :py:meth:`.cache.QueryCache.info`), or None if there is no cache"""
+
+    return self.m_cache.info() if self.m_cache is not None else None
+
+  def __cached__(self, key, query, mapped=False):
+    """Returns the result of the given query, through the query cache if
+    there is one. Queries of ``mapped`` objects are not cached (unless they
+    are answered by the snapshot, with records): the objects are bound to the
+    session of this object, which must not be used by other threads or
+    processes."""
+
+    if self.m_cache is None or (mapped and not self.m_use_snapshot):
+      return query()
+    # the objects returned in snapshot mode are records, even if the mapped
+    # objects were requested
+    key = (self.m_use_snapshot,) + key
+    self.m_cache.validate(os.path.getmtime(SQLITE_FILE))
+    found, value = self.m_cache.get(key)
+    if not found:
+      value = tuple(query())
+      self.m_cache.put(key, value)
+    return value
+
+  def snapshot(self):
+    """Returns the in-memory :py:class:`.snapshot.Snapshot` of this database,
+    loading it if needed"""
+
+    from . import snapshot
+    self.assert_validity()
+    return snapshot.load(self, SQLITE_FILE)
 
   def __group_replace_eval_by_genuine__(self, l):
     """Replace 'eval' by 'Genuine' and returns the new list"""
@@ -65,7 +194,7 @@ class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.ut
 
     return ProtocolPurpose.group_choices
 
-  def clients(self, protocol=None, groups=None):
+  def clients(self, protocol=None, groups=None, lightweight=False):
     """Returns a list of :py:class:`.Client` for the specific query by the user.
 
     Keyword Parameters:
@@ -78,19 +207,33 @@ class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.ut
       Note that 'eval' is an alias for 'Genuine'.
       If no groups are specified, then both clients are impostors are listed.
 
+    lightweight
+      If set, :py:class:`.ClientRecord` objects are returned instead of the
+      mapped :py:class:`.Client` objects.
+
     Returns: A list containing all the clients which have the given properties.
     """
 
     groups = self.__group_replace_eval_by_genuine__(groups)
     groups = self.check_parameters_for_validity(groups, "group", self.client_types())
+    return self.__cached__(('clients', frozenset(groups or ()), lightweight),
+        lambda: self.__clients__(groups, lightweight), mapped=not lightweight)
+
+  def __clients__(self, groups, lightweight):
+    """Queries the clients for :py:meth:`clients`"""
+
+    if self.m_use_snapshot:
+      return self.snapshot().clients(groups)
     # List of the clients
-    q = self.query(Client)
+    q = self.query(*ClientRecord.columns()) if lightweight else self.query(Client)
     if groups:
       q = q.filter(Client.stype.in_(groups))
     q = q.order_by(Client.id)
+    if lightweight:
+      return [ClientRecord(*row) for row in q]
     return list(q)
 
-  def models(self, protocol=None, groups=None):
+  def models(self, protocol=None, groups=None, lightweight=False):
     """Returns a list of :py:class:`.Client` for the specific query by the user.
        Models correspond to Clients for this database (At most one model per identity).
 
@@ -103,22 +246,38 @@ class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.ut
       The groups to which the subjects attached to the models belong ('Genuine')
       Note that 'dev', 'eval' and 'world' are alias for 'Genuine'.
 
+    lightweight
+      If set, :py:class:`.ClientRecord` objects are returned instead of the
+      mapped :py:class:`.Client` objects.
+
     Returns: A list containing all the models (model <-> client in BiosecurID) belonging
              to the given group.
     """
 
-    groups = self.__group_replace_eval_by_genuine__(groups)
-    groups = self.check_parameters_for_validity(groups, "group", ('genuine',))
+    stypes = self.__models_types__(groups)
+    return self.__cached__(('models', frozenset(stypes), lightweight),
+        lambda: self.__models__(stypes, lightweight), mapped=not lightweight)
+
+  def __models__(self, stypes, lightweight):
+    """Queries the models for :py:meth:`models`"""
 
+    if self.m_use_snapshot:
+      return self.snapshot().clients(stypes)
     # List of the clients
-    q = self.query(Client)
-    if groups:
-      q = q.filter(Client.stype.in_(groups))
-    else:
-      q = q.filter(Client.stype.in_(['genuine']))
-    q = q.order_by(Client.id)
+    q = self.query(*ClientRecord.columns()) if lightweight else self.query(Client)
+    q = q.filter(Client.stype.in_(stypes)).order_by(Client.id)
+    if lightweight:
+      return [ClientRecord(*row) for row in q]
     return list(q)
 
+  def __models_types__(self, groups):
+    """Checks the groups of :py:meth:`models` and returns the corresponding
+    client types"""
+
+    groups = self.__group_replace_eval_by_genuine__(groups)
+    groups = self.check_parameters_for_validity(groups, "group", ('genuine',))
+    return groups or ('genuine',)
+
   def model_ids(self, protocol=None, groups=None):
     """Returns a list of model ids for the specific query by the user.
        Models correspond to Clients for the XM2VTS database (At most one model per identity).
@@ -137,21 +296,38 @@ class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.ut
              to the given group.
     """
 
-    return [client.subid for client in self.models(protocol, groups)]
+    stypes = self.__models_types__(groups)
+    return self.__cached__(('model_ids', frozenset(stypes)),
+        lambda: self.__model_ids__(stypes))
+
+  def __model_ids__(self, stypes):
+    """Queries the model ids for :py:meth:`model_ids`"""
+
+    if self.m_use_snapshot:
+      return [client.subid for client in self.snapshot().clients(stypes)]
+    q = self.query(Client.subid).filter(Client.stype.in_(stypes)).order_by(Client.id)
+    return [subid for (subid,) in q]
 
   def has_client_id(self, id):
-    """Returns True if we have a client with a certain integer identifier"""
+    """Returns True if we have a client with a certain integer identifier (or
+    string identifier, e.g. 'genuine_51')"""
 
+    id = Client.to_id(id)
+    if self.m_use_snapshot:
+      return self.snapshot().has_client_id(id)
     return self.query(Client).filter(Client.id==id).count() != 0
 
   def client(self, id):
-    """Returns the client object in the database given a certain id. Raises
-    an error if that does not exist."""
+    """Returns the client object in the database given a certain id (integer
+    or string, e.g. 'genuine_51'). Raises an error if that does not exist."""
 
+    id = Client.to_id(id)
+    if self.m_use_snapshot:
+      return self.snapshot().client(id)
     return self.query(Client).filter(Client.id==id).one()
 
   def objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
-              classes=None):
+              classes=None, lightweight=False, shard=None, shard_by='file'):
     """Returns a list of :py:class:`.File` for the specific query by the user.
 
     Keyword Parameters:
@@ -180,78 +356,451 @@ class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.ut
       or a tuple with several of them. If 'None' is given (this is the
       default), it is considered the same as a tuple with all possible values.
 
-    Returns: A list of :py:class:`.File` objects.
+    lightweight
+      If set, :py:class:`.FileRecord` objects are returned instead of the
+      mapped :py:class:`.File` objects. They only hold the columns of the
+      file table, but are much cheaper to build.
+
+    shard
+      If given, only retrieves the k-th of N disjoint shards of the
+      selection, given as a string 'k/N' or a tuple (k, N), with k counted
+      from 1. The shards are computed by the database, so that each one can
+      be fetched by a different process or machine.
+
+    shard_by
+      How the files are assigned to the shards: by file id ('file', this is
+      the default) or by model id ('client'), so that all files of one model
+      (and of its skilled impostors) are in the same shard. The random
+      impostor probes are shared by all models, so with 'client' they are
+      part of every shard.
+
+    Returns: A list of :py:class:`.File` objects, sorted by
+    :py:meth:`.File.sort_key` (client, session, shot and file id). The order
+    is computed by the database and does not change between processes.
+    """
+
+    protocol, purposes, model_ids, groups, classes = \
+        self.__objects_parameters__(protocol, purposes, model_ids, groups, classes)
+    shard = self.__shard_parameters__(shard, shard_by)
+    key = ('objects', frozenset(protocol), frozenset(purposes), frozenset(model_ids),
+        frozenset(groups), frozenset(classes), lightweight, shard)
+    return self.__cached__(key,
+        lambda: self.__objects__(protocol, purposes, model_ids, groups, classes, lightweight, shard),
+        mapped=not lightweight)
+
+  def __objects__(self, protocol, purposes, model_ids, groups, classes, lightweight, shard):
+    """Queries the files for :py:meth:`objects`"""
+
+    if self.m_use_snapshot:
+      files = self.snapshot().objects(protocol, purposes, model_ids, groups, classes)
+      if shard is None:
+        return files
+      k, n, by_client = shard
+      if by_client:
+        snapshot = self.snapshot()
+        return [f for f in files if self.__client_shard__(snapshot.client(f.client_id), k, n)]
+      return [f for f in files if f.id % n == k]
+
+    # Now query the database
+    entities = FileRecord.columns() if lightweight else (File,)
+    q = self.__objects_query__(entities, protocol, purposes, model_ids, groups, classes, shard)
+    if q is None:
+      return []
+    if lightweight:
+      return [FileRecord(*row) for row in q]
+    return list(q)
+
+  def iter_objects(self, protocol=None, purposes=None, model_ids=None, groups=None,
+                   classes=None, lightweight=False, shard=None, shard_by='file', batch_size=1000):
+    """Iterates over the files for the specific query by the user, like
+    :py:meth:`objects` returns them, without building the whole list. The
+    duplicates are removed by the database, and the rows are fetched and
+    turned into objects in batches of ``batch_size``, so that the memory used
+    does not depend on the number of files. The other keyword parameters are
+    the same as for :py:meth:`objects`.
+    """
+
+    protocol, purposes, model_ids, groups, classes = \
+        self.__objects_parameters__(protocol, purposes, model_ids, groups, classes)
+    shard = self.__shard_parameters__(shard, shard_by)
+    if self.m_use_snapshot:
+      for f in self.__objects__(protocol, purposes, model_ids, groups, classes, lightweight, shard):
+        yield f
+      return
+
+    entities = FileRecord.columns() if lightweight else (File,)
+    q = self.__objects_query__(entities, protocol, purposes, model_ids, groups, classes, shard)
+    if q is None:
+      return
+    for row in q.execution_options(stream_results=True).yield_per(batch_size):
+      yield FileRecord(*row) if lightweight else row
+
+  def objects_array(self, protocol=None, purposes=None, model_ids=None, groups=None,
+                    classes=None):
+    """Returns the files for the specific query by the user as NumPy arrays,
+    so that they can be masked and grouped in a vectorized way. The keyword
+    parameters are the same as for :py:meth:`objects`.
+
+    Returns: A tuple ``(files, paths)``. ``files`` is a structured array with
+    the fields ``id``, ``subid``, ``session_id``, ``shot_id`` and the codes
+    ``stype`` (index in :py:attr:`.Client.type_choices`), ``sgroup`` (index in
+    :py:attr:`.Client.group_choices`), ``purpose`` (index in
+    :py:attr:`.ProtocolPurpose.purpose_choices`) and ``sclass`` (index in
+    ``class_choices``). Codes which do not apply (e.g., the purpose and class
+    of the world data) are set to -1. ``paths`` holds the path of each row.
+    The rows are sorted like the ones of :py:meth:`objects`.
     """
 
+    protocol, purposes, model_ids, groups, classes = \
+        self.__objects_parameters__(protocol, purposes, model_ids, groups, classes)
+    entities = FileRecord.columns() + (Client.subid, Client.stype, Client.sgroup, ProtocolPurpose.purpose)
+    q = self.__objects_query__(entities, protocol, purposes, model_ids, groups, classes)
+    rows = list(q) if q is not None else []
+
+    stype_codes = dict((v, k) for k, v in enumerate(Client.type_choices))
+    sgroup_codes = dict((v, k) for k, v in enumerate(Client.group_choices))
+    purpose_codes = dict((v, k) for k, v in enumerate(ProtocolPurpose.purpose_choices))
+    sclass_codes = dict((v, k) for k, v in enumerate(class_choices))
+
+    files = numpy.array([(
+        file_id, subid, stype_codes[stype], sgroup_codes[sgroup], session_id, shot_id,
+        purpose_codes.get(purpose, -1),
+        sclass_codes.get(self.__probe_class__(stype, sgroup, purpose), -1),
+      ) for (file_id, client_id, path, session_id, shot_id, subid, stype, sgroup, purpose) in rows],
+      dtype=objects_array_dtype)
+    paths = numpy.array([row[2] for row in rows], dtype=object)
+    return files, paths
+
+  def object_rows(self, protocol=None, purposes=None, model_ids=None, groups=None,
+                  classes=None, batch_size=1000, shard=None, shard_by='file'):
+    """Iterates over the files for the specific query by the user, together
+    with their client and their role in the protocol. The rows are streamed
+    from the database in batches of ``batch_size``, without building the whole
+    list. The other keyword parameters are the same as for
+    :py:meth:`objects`.
+
+    Yields: ``(file, client, purpose, sclass)`` tuples, where ``file`` is a
+    :py:class:`.FileRecord`, ``client`` is the :py:attr:`.Client.name` of its
+    client and ``purpose`` and ``sclass`` are its purpose and class (None if
+    they do not apply, e.g. for the world data). The rows are sorted like the
+    ones of :py:meth:`objects`; a file is yielded once per purpose it has in
+    the selected protocols.
+    """
+
+    protocol, purposes, model_ids, groups, classes = \
+        self.__objects_parameters__(protocol, purposes, model_ids, groups, classes)
+    shard = self.__shard_parameters__(shard, shard_by)
+    entities = FileRecord.columns() + (Client.stype, Client.subid, Client.sgroup, ProtocolPurpose.purpose)
+    q = self.__objects_query__(entities, protocol, purposes, model_ids, groups, classes, shard)
+    if q is None:
+      return
+    for row in q.execution_options(stream_results=True).yield_per(batch_size):
+      stype, subid, sgroup, purpose = row[5:]
+      yield (FileRecord(*row[:5]), '%s_%d' % (stype, subid),
+          None if sgroup == 'world' else purpose,
+          self.__probe_class__(stype, sgroup, purpose))
+
+  def __probe_class__(self, stype, sgroup, purpose):
+    """Returns the class (one of ``class_choices``) of a probe file of the
+    given client type and group, or None for other files"""
+
+    if purpose != 'probe':
+      return None
+    return {
+        ('genuine', 'clientEval'): 'client',
+        ('skilled', 'clientEval'): 'skilledImpostor',
+        ('genuine', 'impostorEval'): 'randomImpostor',
+        }.get((stype, sgroup))
+
+  def __objects_parameters__(self, protocol, purposes, model_ids, groups, classes):
+    """Checks and normalizes the parameters of :py:meth:`objects`"""
+
     #groups = self.__group_replace_alias_clients__(groups)
     protocol = self.check_parameters_for_validity(protocol, "protocol", self.protocol_names())
     purposes = self.check_parameters_for_validity(purposes, "purpose", self.purposes())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
-    classes = self.check_parameters_for_validity(classes, "class", ('client', 'skilledImpostor', 'randomImpostor'))
+    classes = self.check_parameters_for_validity(classes, "class", class_choices)
 
-    import collections
     if(model_ids is None):
       model_ids = ()
-    elif(not isinstance(model_ids,collections.Iterable)):
+    elif(not isinstance(model_ids, Iterable)):
       model_ids = (model_ids,)
 
-    # Now query the database
-    retval = []
+    return protocol, purposes, model_ids, groups, classes
+
+  def __shard_parameters__(self, shard, shard_by):
+    """Checks and normalizes the shard of :py:meth:`objects` into a tuple
+    ``(k, N, by_client)`` with k counted from 0, or None"""
+
+    if shard is None:
+      return None
+    shard_by = self.check_parameter_for_validity(shard_by, "shard_by", ('file', 'client'))
+    try:
+      if isinstance(shard, six.string_types):
+        shard = shard.split('/')
+      k, n = [int(v) for v in shard]
+    except (TypeError, ValueError):
+      raise ValueError("Invalid shard '%s', it must be of the form 'k/N'" % (shard,))
+    if not 1 <= k <= n:
+      raise ValueError("Invalid shard %d/%d, it must be between 1/%d and %d/%d" % (k, n, n, n, n))
+    return (k - 1, n, shard_by == 'client')
+
+  def __client_shard__(self, client, k, n):
+    """Tells if the files of the given client are in the k-th (from 0) of n
+    shards by client, like the SQL condition of :py:meth:`__objects_query__`"""
+
+    return client.sgroup == 'impostorEval' or client.subid % n == k
+
+  def __objects_query__(self, entities, protocol, purposes, model_ids, groups, classes, shard=None):
+    """Compiles the (checked) selection of :py:meth:`objects` into a single query over
+    the File, Client, ProtocolPurpose and Protocol tables, returning the given
+    entities. Each selected group/purpose/class combination becomes one OR'ed
+    predicate, duplicates are removed by the database and the rows are sorted
+    by :py:meth:`.File.sort_key`. If a (checked) shard is given, only its
+    rows are selected. Returns None if nothing can match the selection."""
+
+    branches = []
 
     if 'world' in groups:
-      q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-            filter(Client.sgroup == 'world').\
-            filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup == 'world'))
+      world = and_(Client.sgroup == 'world', ProtocolPurpose.sgroup == 'world')
       if model_ids:
-        q = q.filter(Client.id.in_(model_ids))
-      q = q.order_by(File.client_id, File.session_id, File.shot_id)
-      retval += list(q)
-    
+        world = and_(world, Client.id.in_([Client.to_id(k) for k in model_ids]))
+      branches.append(world)
+
     if ('eval' in groups):
+      evaluation = ProtocolPurpose.sgroup.in_(groups)
+
       if('enrol' in purposes):
-        q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-              filter(Client.stype.in_(['genuine'])).\
-              filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'enrol'))
+        enrol = and_(Client.stype.in_(['genuine']), evaluation, ProtocolPurpose.purpose == 'enrol')
         if model_ids:
-          q = q.filter(Client.subid.in_(model_ids))
-        q = q.order_by(File.client_id, File.session_id, File.shot_id)
-        retval += list(q)
+          enrol = and_(enrol, Client.subid.in_(model_ids))
+        branches.append(enrol)
 
       if('probe' in purposes):
+        probe = and_(evaluation, ProtocolPurpose.purpose == 'probe')
+
         if('client' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-                filter(and_(Client.stype.in_(['genuine']),Client.sgroup.in_(['clientEval']))).\
-                filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'probe'))
+          client = and_(probe, Client.stype.in_(['genuine']), Client.sgroup.in_(['clientEval']))
           if model_ids:
-            q = q.filter(Client.subid.in_(model_ids))
-          q = q.order_by(File.client_id, File.session_id, File.shot_id)
-          retval += list(q)
+            client = and_(client, Client.subid.in_(model_ids))
+          branches.append(client)
 
         if('skilledImpostor' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-                filter(and_(Client.stype.in_(['skilled']),Client.sgroup.in_(['clientEval']))).\
-                filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'probe'))
+          skilled = and_(probe, Client.stype.in_(['skilled']), Client.sgroup.in_(['clientEval']))
           if model_ids:
-            q = q.filter(Client.subid.in_(model_ids))
-          q = q.order_by(File.client_id, File.session_id, File.shot_id)
-          retval += list(q)
-        
+            skilled = and_(skilled, Client.subid.in_(model_ids))
+          branches.append(skilled)
+
         if('randomImpostor' in classes):
-          q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-                filter(and_(Client.stype.in_(['genuine']),Client.sgroup.in_(['impostorEval']))).\
-                filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'probe'))
-          q = q.order_by(File.client_id, File.session_id, File.shot_id)
-          retval += list(q)
-          
-          """q = self.query(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
-                filter(Client.sgroup == 'client').\
-                filter(and_(Protocol.name.in_(protocol), ProtocolPurpose.sgroup.in_(groups), ProtocolPurpose.purpose == 'probe'))
-          if(len(model_ids) == 1):
-            q = q.filter(not_(Client.id.in_(model_ids)))
-          q = q.order_by(File.client_id, File.session_id, File.shot_id)
-          retval += list(q)"""
-
-    return list(set(retval)) # To remove duplicates
+          # random impostors are shared by all models, model_ids do not apply
+          branches.append(and_(probe, Client.stype.in_(['genuine']), Client.sgroup.in_(['impostorEval'])))
+
+    if not branches:
+      return None
+
+    q = self.query(*entities).select_from(File).join(Client).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol).\
+          filter(Protocol.name.in_(protocol)).\
+          filter(or_(*branches))
+    if shard is not None:
+      k, n, by_client = shard
+      if by_client:
+        # the random impostors are shared by all models, so by all shards
+        q = q.filter(or_(Client.subid % n == k, Client.sgroup == 'impostorEval'))
+      else:
+        q = q.filter(File.id % n == k)
+    q = q.distinct() # To remove duplicates
+    return q.order_by(File.client_id, File.session_id, File.shot_id, File.id)
+
+  def files(self, ids, preserve_order=True, ignore_missing=False):
+    """Returns a list of :py:class:`.File` objects with the given file ids.
+
+    The ids are looked up in batches of :py:attr:`lookup_chunk_size` (or in
+    the snapshot, if enabled). The files are returned in the order of the
+    ids, unless ``preserve_order`` is False. Unknown ids are skipped if
+    ``ignore_missing`` is set, otherwise a KeyError listing all of them is
+    raised.
+    """
+
+    ids = list(ids)
+    if self.m_use_snapshot:
+      return self.snapshot().files(ids, preserve_order, ignore_missing)
+    return pick_files(self.__lookup__(File.id, ids), ids, 'id', preserve_order, ignore_missing)
+
+  def paths(self, ids, prefix=None, suffix=None, preserve_order=True, ignore_missing=False):
+    """Returns a full file paths considering particular file ids (see
+    :py:meth:`files`)"""
+
+    return [f.make_path(prefix, suffix) for f in self.files(ids, preserve_order, ignore_missing)]
+
+  def reverse(self, paths, preserve_order=True, ignore_missing=False):
+    """Reverses the lookup: from certain paths, returns a list of
+    :py:class:`.File` objects (see :py:meth:`files`)"""
+
+    paths = list(paths)
+    if self.m_use_snapshot:
+      return self.snapshot().reverse(paths, preserve_order, ignore_missing)
+    return pick_files(self.__lookup__(File.path, paths), paths, 'path', preserve_order, ignore_missing)
+
+  def __lookup__(self, column, keys):
+    """Returns a dictionary with the :py:class:`.File` objects whose given
+    column has one of the given values, querying them in batches"""
+
+    retval = {}
+    keys = sorted(set(keys))
+    for k in range(0, len(keys), self.lookup_chunk_size):
+      for f in self.query(File).filter(column.in_(keys[k:k+self.lookup_chunk_size])):
+        retval[getattr(f, column.key)] = f
+    return retval
+
+  def model_trials(self, protocol, model_id):
+    """Returns the files of the trials of one model, as a
+    :py:class:`.snapshot.ModelTrials` tuple of :py:class:`.FileRecord`
+    objects ``(enrol, client, skilledImpostor, randomImpostor)``.
+
+    The files of all models of the protocol are indexed in memory on the first
+    call, so that the subsequent calls do not query the database. The random
+    impostor probes are shared by all models.
+
+    Keyword Parameters:
+
+    protocol
+      One of the BiosecurID protocols ('skilledImpostors', 'randomImpostors').
+
+    model_id
+      The id of one of the evaluation models (the genuine clients of the
+      'clientEval' group, 51 to 350). The other ids returned by
+      :py:meth:`model_ids` (e.g. the ones of the world clients) have no
+      trials, and a ValueError is raised for them.
+    """
+
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    index = self.snapshot().model_trials(protocol)
+    if model_id not in index:
+      raise ValueError("Model id %s is not one of the evaluation models of protocol '%s'" % (model_id, protocol))
+    return index[model_id]
+
+  def iter_model_trials(self, protocol):
+    """Iterates over the models of the given protocol, sorted by model id,
+    yielding ``(model_id, trials)`` tuples like :py:meth:`model_trials`
+    returns them, without querying the database again."""
+
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    index = self.snapshot().model_trials(protocol)
+    for model_id in sorted(index):
+      yield model_id, index[model_id]
+
+  def trials(self, protocol, chunk_size=None):
+    """Generates the client and skilled impostor trials of the given
+    protocol, as NumPy arrays. The random impostor trials, which are shared by
+    all models, are generated by :py:meth:`random_trials`.
+
+    Keyword Parameters:
+
+    protocol
+      One of the BiosecurID protocols ('skilledImpostors', 'randomImpostors').
+
+    chunk_size
+      The number of models in each chunk. If 'None' is given (this is the
+      default), all models are returned in one chunk.
+
+    Yields: For each chunk of models, a tuple ``(model_ids, probe_ids,
+    labels)`` of 1D arrays with one entry per trial, where ``probe_ids`` are
+    :py:class:`.File` ids and ``labels`` are indexes in ``class_choices``.
+    """
+
+    index, chunks = self.__trial_chunks__(protocol, chunk_size)
+    client = class_choices.index('client')
+    skilled = class_choices.index('skilledImpostor')
+
+    for models in chunks:
+      m, p, l = [], [], []
+      for model_id in models:
+        t = index[model_id]
+        m.append(numpy.repeat(model_id, len(t.client) + len(t.skilledImpostor)))
+        p.append([f.id for f in t.client] + [f.id for f in t.skilledImpostor])
+        l.append([client] * len(t.client) + [skilled] * len(t.skilledImpostor))
+      yield (numpy.concatenate(m).astype(numpy.int32),
+          numpy.concatenate(p).astype(numpy.int32),
+          numpy.concatenate(l).astype(numpy.int8))
+
+  def random_trials(self, protocol, chunk_size=None):
+    """Generates the random impostor trials of the given protocol, which are
+    shared by all models (nothing is generated if the protocol has none). The
+    keyword parameters are the same as for :py:meth:`trials`.
+
+    Yields: For each chunk of models, a tuple ``(model_ids, probe_ids,
+    labels)`` of read-only 2D views of shape ``(models, probes)``, which are
+    broadcast from the models and the probes without being materialized.
+    """
+
+    index, chunks = self.__trial_chunks__(protocol, chunk_size)
+    if not chunks:
+      return
+    random = numpy.int8(class_choices.index('randomImpostor'))
+    random_ids = numpy.array([f.id for f in index[chunks[0][0]].randomImpostor], dtype=numpy.int32)
+    if not len(random_ids):
+      return
+
+    for models in chunks:
+      yield tuple(numpy.broadcast_arrays(
+        numpy.array(models, dtype=numpy.int32)[:, None], random_ids[None, :], random))
+
+  def __trial_chunks__(self, protocol, chunk_size):
+    """Returns the model trials of the given protocol (see
+    :py:meth:`model_trials`) and the sorted model ids, split in chunks"""
+
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocol_names())
+    index = self.snapshot().model_trials(protocol)
+    model_ids = sorted(index)
+    chunk_size = chunk_size or max(len(model_ids), 1)
+    return index, [model_ids[k:k+chunk_size] for k in range(0, len(model_ids), chunk_size)]
+
+  def load_features(self, directory=None, extension=None, jobs=None, **kwargs):
+    """Reads the global features of the files selected by :py:meth:`objects`
+    into a single matrix (see :py:func:`.features.load`).
+
+    Keyword Parameters:
+
+    directory, extension
+      The directory and extension of the feature files. If 'None' is given
+      (this is the default), the ``original_directory`` and
+      ``original_extension`` of this database are used.
+
+    jobs
+      The number of processes parsing the files in parallel (one per CPU, by
+      default).
+
+    The remaining keyword parameters select the files, as in
+    :py:meth:`objects`.
+
+    Returns: A tuple ``(ids, features)`` with the :py:class:`.File` ids and a
+    2D float array with the features of each file, one row per file. If no
+    file is selected, ``features`` has the shape ``(0, 0)``.
+    """
+
+    from . import features
+    if directory is None: directory = self.original_directory
+    if extension is None: extension = self.original_extension
+    files = self.objects(lightweight=True, **kwargs)
+    return features.load(files, directory, extension, jobs=jobs)
+
+  def feature_cache(self, filename, directory=None, extension=None, jobs=None, **kwargs):
+    """Opens the binary feature cache with the given name (see
+    :py:class:`.features.FeatureCache`), after building it or refreshing the
+    rows of the files that were modified since it was built.
+
+    The keyword parameters are the same as for :py:meth:`load_features`.
+
+    Returns: A tuple ``(ids, features)`` with the :py:class:`.File` ids and a
+    read-only memory-mapped 2D array with the features of each file.
+    """
+
+    from . import features
+    if directory is None: directory = self.original_directory
+    if extension is None: extension = self.original_extension
+    cache = features.FeatureCache(filename)
+    cache.update(self.objects(lightweight=True, **kwargs), directory, extension, jobs=jobs)
+    return cache.open()
 
   def protocol_names(self):
     """Returns all registered protocol names"""
@@ -263,6 +812,8 @@ class Database(xbob.db.verification.utils.SQLiteDatabase,xbob.db.verification.ut
   def protocols(self):
     """Returns all registered protocols"""
 
+    if self.m_use_snapshot:
+      return self.snapshot().protocols()
     return list(self.query(Protocol))
 
   def has_protocol(self, name):
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""An in-memory snapshot of the BiosecurID Signature Global Features
+database. The whole content of the SQLite file is loaded once into compact
+indexes, which are then used to answer the queries without going back to
+SQLite.
+"""
+
+import os
+import time
+import collections
+from .models import *
+
+# the snapshots loaded so far, indexed by SQLite file
+_snapshots = {}
+
+# the number of seconds during which a snapshot is used without checking if
+# its SQLite file was modified
+CHECK_INTERVAL = 1.0
+
+def load(database, sqlite_file):
+  """Returns the :py:class:`Snapshot` of the given SQLite file, loading it
+  through the given :py:class:`.query.Database` if it has not been loaded yet
+  or if the file was modified since (which is checked at most once every
+  :py:data:`CHECK_INTERVAL` seconds)."""
+
+  now = time.time()
+  snapshot = _snapshots.get(sqlite_file)
+  if snapshot is not None and now - snapshot.checked < CHECK_INTERVAL:
+    return snapshot
+  mtime = os.path.getmtime(sqlite_file)
+  if snapshot is None or snapshot.mtime != mtime:
+    snapshot = _snapshots[sqlite_file] = Snapshot(database, mtime)
+  snapshot.checked = now
+  return snapshot
+
+
+def pick_files(index, keys, what, preserve_order=True, ignore_missing=False):
+  """Returns the files of the given keys (ids or paths), looked up in the
+  given dictionary.
+
+  The files are returned in the order of the keys, or sorted like
+  :py:meth:`.query.Database.objects` if ``preserve_order`` is False. Keys
+  which are not found are skipped if ``ignore_missing`` is set; otherwise, a
+  single KeyError listing all of them is raised.
+  """
+
+  missing = [k for k in keys if k not in index]
+  if missing and not ignore_missing:
+    raise KeyError("%d file %s(s) not found: %s" % (len(missing), what, ', '.join(str(k) for k in missing)))
+  retval = [index[k] for k in keys if k in index]
+  if not preserve_order:
+    retval.sort(key=lambda f: f.sort_key())
+  return retval
+
+
+# the files of the trials of one model: enrolment files and the probes of
+# each class. The random impostor probes are shared by all models.
+ModelTrials = collections.namedtuple('ModelTrials', ('enrol', 'client', 'skilledImpostor', 'randomImpostor'))
+
+
+class Snapshot(object):
+  """The content of the database, indexed in memory. The methods of this
+  class expect parameters which were already checked and normalized by
+  :py:class:`.query.Database`, and return :py:class:`.ClientRecord`,
+  :py:class:`.FileRecord` and :py:class:`.ProtocolRecord` objects."""
+
+  def __init__(self, database, mtime):
+    self.mtime = mtime
+
+    self.m_protocols = [ProtocolRecord(*row) for row in
+        database.query(*ProtocolRecord.columns()).order_by(Protocol.id)]
+
+    self.m_clients = [ClientRecord(*row) for row in
+        database.query(*ClientRecord.columns()).order_by(Client.id)]
+    self.m_client_by_id = dict((c.id, c) for c in self.m_clients)
+
+    files = [FileRecord(*row) for row in database.query(*FileRecord.columns())]
+    files.sort(key=FileRecord.sort_key)
+    self.m_file_by_id = dict((f.id, f) for f in files)
+    self.m_file_by_path = dict((f.path, f) for f in files)
+    # the rank of each file in the sorting order of the queries
+    self.m_rank = dict((f.id, k) for k, f in enumerate(files))
+
+    # the files attached to each (protocol, group, purpose) and belonging to
+    # the clients of each (type, group), indexed by subject id and sorted
+    # like the results of the queries
+    self.m_index = {}
+    self.m_purposes = set()
+    q = database.query(Protocol.name, ProtocolPurpose.sgroup, ProtocolPurpose.purpose, File.id).\
+          select_from(File).join((ProtocolPurpose, File.protocolPurposes)).join(Protocol)
+    for name, sgroup, purpose, file_id in q:
+      f = self.m_file_by_id[file_id]
+      c = self.m_client_by_id[f.client_id]
+      self.m_index.setdefault((name, sgroup, purpose, c.stype, c.sgroup), {}).\
+          setdefault(c.subid, []).append(f)
+      self.m_purposes.add(purpose)
+    for subjects in self.m_index.values():
+      for files in subjects.values():
+        files.sort(key=lambda f: self.m_rank[f.id])
+
+    # the per-model indexes built so far, by protocol
+    self.m_model_trials = {}
+
+  def __members__(self, protocol, groups, purposes, stype, sgroup, subids=None):
+    """Returns the lists of files attached to the given protocols, groups and
+    purposes, belonging to the clients of the given type and group (and
+    subject ids, if given)"""
+
+    retval = []
+    for name in protocol:
+      for group in groups:
+        for purpose in purposes:
+          subjects = self.m_index.get((name, group, purpose, stype, sgroup))
+          if not subjects:
+            continue
+          if subids is None:
+            retval.extend(subjects.values())
+          else:
+            retval.extend(subjects[k] for k in subids if k in subjects)
+    return retval
+
+  def protocols(self):
+    """Returns all registered protocols"""
+
+    return list(self.m_protocols)
+
+  def clients(self, stypes=None):
+    """Returns the clients of the given types (all of them if None)"""
+
+    return [c for c in self.m_clients if not stypes or c.stype in stypes]
+
+  def client(self, id):
+    """Returns the client with the given id, raises a KeyError if it does not
+    exist"""
+
+    return self.m_client_by_id[id]
+
+  def has_client_id(self, id):
+    """Returns True if we have a client with the given id"""
+
+    return id in self.m_client_by_id
+
+  def objects(self, protocol, purposes, model_ids, groups, classes):
+    """Returns the files selected by :py:meth:`.query.Database.objects`, in
+    the same order. The lists of files of the selected (protocol, group,
+    purpose, client type, client group, subject) are looked up in the index
+    and merged."""
+
+    models = list(set(model_ids)) or None
+
+    # lists of files, each one sorted
+    lists = []
+
+    if 'world' in groups:
+      clients = None
+      if models is not None:
+        clients = [self.m_client_by_id[k] for k in set(Client.to_id(k) for k in models) if k in self.m_client_by_id]
+      for stype in Client.type_choices:
+        subids = None if clients is None else [c.subid for c in clients if c.stype == stype]
+        lists.extend(self.__members__(protocol, ('world',), self.m_purposes, stype, 'world', subids))
+
+    if 'eval' in groups:
+      if 'enrol' in purposes:
+        for sgroup in Client.group_choices:
+          lists.extend(self.__members__(protocol, groups, ('enrol',), 'genuine', sgroup, models))
+
+      if 'probe' in purposes:
+        if 'client' in classes:
+          lists.extend(self.__members__(protocol, groups, ('probe',), 'genuine', 'clientEval', models))
+        if 'skilledImpostor' in classes:
+          lists.extend(self.__members__(protocol, groups, ('probe',), 'skilled', 'clientEval', models))
+        if 'randomImpostor' in classes:
+          # random impostors are shared by all models, model_ids do not apply
+          lists.extend(self.__members__(protocol, groups, ('probe',), 'genuine', 'impostorEval'))
+
+    if len(lists) == 1:
+      return list(lists[0])
+    selected = dict((f.id, f) for files in lists for f in files)
+    return sorted(selected.values(), key=lambda f: self.m_rank[f.id])
+
+  def files(self, ids, preserve_order=True, ignore_missing=False):
+    """Returns the files with the given ids (see :py:func:`pick_files`)"""
+
+    return pick_files(self.m_file_by_id, ids, 'id', preserve_order, ignore_missing)
+
+  def reverse(self, paths, preserve_order=True, ignore_missing=False):
+    """Returns the files with the given paths (see :py:func:`pick_files`)"""
+
+    return pick_files(self.m_file_by_path, paths, 'path', preserve_order, ignore_missing)
+
+  def model_trials(self, protocol):
+    """Returns a dictionary with the :py:class:`ModelTrials` of each model
+    (indexed by model id) of the given protocol. The dictionary is built on
+    the first call for each protocol."""
+
+    index = self.m_model_trials.get(protocol)
+    if index is not None:
+      return index
+
+    def by_model(purpose, sclass):
+      retval = {}
+      for f in self.objects((protocol,), (purpose,), (), ('eval',), (sclass,)):
+        retval.setdefault(self.m_client_by_id[f.client_id].subid, []).append(f)
+      return retval
+
+    enrol = by_model('enrol', 'client')
+    client = by_model('probe', 'client')
+    skilled = by_model('probe', 'skilledImpostor')
+    # the same tuple is shared by all models (empty if the protocol has none)
+    random = tuple(self.objects((protocol,), ('probe',), (), ('eval',), ('randomImpostor',)))
+
+    index = {}
+    for c in self.m_clients:
+      if c.stype == 'genuine' and c.sgroup == 'clientEval':
+        index[c.subid] = ModelTrials(
+            tuple(enrol.get(c.subid, ())),
+            tuple(client.get(c.subid, ())),
+            tuple(skilled.get(c.subid, ())),
+            random)
+    self.m_model_trials[protocol] = index
+    return index
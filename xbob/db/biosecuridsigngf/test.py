@@ -17,9 +17,15 @@
 """
 
 import os, sys
+import six
 import unittest
 from .query import Database
 
+def _count_models(args):
+  """Counts the files of one model, in a worker process"""
+  db, model_id = args
+  return len(db.objects(protocol='skilledImpostors', model_ids=[model_id]))
+
 class BiosecurIDSignGFDatabaseTest(unittest.TestCase):
 
     def test_clients(self):
@@ -73,6 +79,493 @@ class BiosecurIDSignGFDatabaseTest(unittest.TestCase):
 
       from bob.db.script.dbmanage import main
       assert main('biosecuridsigngf dumplist --self-test'.split()) == 0
+      assert main('biosecuridsigngf dumplist --protocol=skilledImpostors --client=51 --self-test'.split()) == 0
+      assert main('biosecuridsigngf dumplist --protocol=unknown --self-test'.split()) == 1
+      assert main('biosecuridsigngf dumplist --client=100000 --self-test'.split()) == 1
       assert main('biosecuridsigngf checkfiles --self-test'.split()) == 0
+      assert main('biosecuridsigngf checkfiles --jobs 4 --verbose --self-test'.split()) == 0
+      assert main('biosecuridsigngf checkfiles --listdir --self-test'.split()) == 0
       assert main('biosecuridsigngf reverse 1_1_genuine --self-test'.split()) == 0
       assert main('biosecuridsigngf path 37 --self-test'.split()) == 0
+
+    def test_objects_single_query(self):
+      db = Database()
+      # duplicates are removed by the database
+      files = db.objects()
+      assert len(set(f.id for f in files)) == len(files)
+      files = db.objects(protocol=('skilledImpostors', 'randomImpostors'), groups='eval', purposes='probe')
+      assert len(set(f.id for f in files)) == len(files)
+      # the compiled selection matches the union of its parts
+      ids = set(f.id for f in db.objects(protocol='randomImpostors', groups='eval', purposes='probe'))
+      parts = set()
+      for c in ('client', 'randomImpostor'):
+        parts |= set(f.id for f in db.objects(protocol='randomImpostors', groups='eval', purposes='probe', classes=c))
+      assert ids == parts
+
+    def test_objects_order(self):
+      db = Database()
+      files = db.objects(protocol='skilledImpostors')
+      keys = [f.sort_key() for f in files]
+      assert keys == sorted(keys)
+      # the order does not depend on the query
+      assert [f.id for f in files] == [f.id for f in Database().objects(protocol='skilledImpostors')]
+
+    def test_lightweight(self):
+      db = Database()
+      files = db.objects(protocol='skilledImpostors', groups='eval', purposes='probe', model_ids=[1])
+      records = db.objects(protocol='skilledImpostors', groups='eval', purposes='probe', model_ids=[1], lightweight=True)
+      assert [f.id for f in files] == [r.id for r in records]
+      assert [f.make_path('dir', '.txt') for f in files] == [r.make_path('dir', '.txt') for r in records]
+      assert [c.id for c in db.clients()] == [c.id for c in db.clients(lightweight=True)]
+      assert [c.subid for c in db.models(lightweight=True)] == db.model_ids()
+
+    def test_objects_array(self):
+      import numpy
+      from .models import class_choices
+      db = Database()
+      files, paths = db.objects_array(protocol='randomImpostors', groups='eval', purposes='probe')
+      assert len(files) == 3650
+      assert len(paths) == len(files)
+      assert list(files['id']) == [f.id for f in db.objects(protocol='randomImpostors', groups='eval', purposes='probe')]
+      assert numpy.sum(files['sclass'] == class_choices.index('randomImpostor')) == 50
+      assert numpy.sum(files['sclass'] == class_choices.index('client')) == 3600
+      assert numpy.sum((files['subid'] == 51) & (files['sclass'] == class_choices.index('client'))) == 12
+
+    def test_snapshot(self):
+      db = Database()
+      snap = Database(snapshot=True)
+      for kwargs in ({}, {'protocol': 'skilledImpostors'}, {'classes': ('client', 'randomImpostor')},
+          {'protocol': 'randomImpostors', 'groups': 'eval', 'purposes': 'probe', 'model_ids': [51, 52]},
+          {'protocol': 'skilledImpostors', 'groups': 'eval', 'purposes': 'probe', 'model_ids': [51]},
+          {'protocol': 'skilledImpostors', 'groups': 'eval', 'purposes': 'enrol', 'model_ids': 53}):
+        assert [f.id for f in snap.objects(**kwargs)] == [f.id for f in db.objects(**kwargs)]
+      assert [c.id for c in snap.clients(groups='skilled')] == [c.id for c in db.clients(groups='skilled')]
+      assert snap.model_ids() == db.model_ids()
+      assert snap.protocol_names() == db.protocol_names()
+      assert snap.reverse(['1_1_genuine'])[0].id == db.reverse(['1_1_genuine'])[0].id
+      assert snap.paths([37], 'dir', '.txt') == db.paths([37], 'dir', '.txt')
+      # the snapshot is shared
+      assert snap.snapshot() is Database(snapshot=True).snapshot()
+
+    def test_model_trials(self):
+      db = Database()
+      trials = db.model_trials('skilledImpostors', 51)
+      assert [f.id for f in trials.enrol] == [f.id for f in db.objects(protocol='skilledImpostors', groups='eval', purposes='enrol', model_ids=[51])]
+      assert len(trials.client) == 12
+      assert len(trials.skilledImpostor) == 12
+      assert len(trials.randomImpostor) == 0
+      models = list(db.iter_model_trials('randomImpostors'))
+      assert len(models) == 300
+      assert all(len(t.randomImpostor) == 50 for m, t in models)
+      assert models[0][1].randomImpostor is models[-1][1].randomImpostor
+      # the world clients are no models
+      self.assertRaises(ValueError, db.model_trials, 'skilledImpostors', 1)
+
+    def test_trials(self):
+      from .models import class_choices
+      db = Database()
+      chunks = list(db.trials('skilledImpostors', chunk_size=100))
+      assert len(chunks) == 3
+      assert sum(len(labels) for models, probes, labels in chunks) == 300 * 24
+      assert list(db.random_trials('skilledImpostors')) == []
+      chunks = list(db.trials('randomImpostors'))
+      assert len(chunks) == 1
+      assert (chunks[0][2] == class_choices.index('client')).all()
+      chunks = list(db.random_trials('randomImpostors', chunk_size=200))
+      assert len(chunks) == 2
+      models, probes, labels = chunks[0]
+      assert models.shape == probes.shape == labels.shape == (200, 50)
+      assert (labels == class_choices.index('randomImpostor')).all()
+
+    def test_load_features(self):
+      import tempfile, shutil
+      import numpy
+      db = Database()
+      files = db.objects(protocol='skilledImpostors', groups='eval', purposes='enrol', model_ids=[51, 52], lightweight=True)
+      assert files
+      directory = tempfile.mkdtemp()
+      try:
+        for f in files:
+          with open(f.make_path(directory, '.txt'), 'w') as out:
+            out.write('%d 1.5\n2.5 %d\n' % (f.id, f.shot_id))
+        ids, features = db.load_features(directory, '.txt', jobs=2, protocol='skilledImpostors', groups='eval', purposes='enrol', model_ids=[51, 52])
+        assert list(ids) == [f.id for f in files]
+        assert features.shape == (len(files), 4)
+        assert (features[:, 0] == ids).all()
+        assert features.flags['C_CONTIGUOUS']
+        # the world subjects have no enrolment files
+        ids, features = db.load_features(directory, '.txt', jobs=1, protocol='skilledImpostors', groups='eval', purposes='enrol', model_ids=[1, 2])
+        assert len(ids) == 0 and features.shape == (0, 0)
+      finally:
+        shutil.rmtree(directory)
+
+    def test_feature_cache(self):
+      import tempfile, shutil
+      from .features import FeatureCache
+      db = Database()
+      files = db.objects(protocol='skilledImpostors', groups='eval', purposes='enrol', model_ids=[51, 52], lightweight=True)
+      assert files
+      directory = tempfile.mkdtemp()
+      try:
+        # an empty selection gives an empty cache
+        empty = FeatureCache(os.path.join(directory, 'empty'))
+        assert empty.update([], directory, '.txt', jobs=1) == 0
+        assert empty.open()[1].shape == (0, 0)
+        for f in files:
+          with open(f.make_path(directory, '.txt'), 'w') as out:
+            out.write('%d 1.5 2.5\n' % f.id)
+        cache = FeatureCache(os.path.join(directory, 'cache'))
+        assert cache.update(files, directory, '.txt', jobs=1) == len(files)
+        assert cache.update(files, directory, '.txt', jobs=1) == 0
+        # a modified file is parsed again
+        with open(files[0].make_path(directory, '.txt'), 'w') as out:
+          out.write('-1 1.5 2.5 \n')
+        assert cache.update(files, directory, '.txt', jobs=1) == 1
+        ids, features = cache.open()
+        assert list(ids) == [f.id for f in files]
+        assert features[0, 0] == -1
+        assert (features[1:, 0] == ids[1:]).all()
+        assert not features.flags['WRITEABLE']
+        # the mapped matrix is not modified by an update
+        with open(files[0].make_path(directory, '.txt'), 'w') as out:
+          out.write('-2 1.5 2.5 \n')
+        assert cache.update(files, directory, '.txt', jobs=1) == 1
+        assert features[0, 0] == -1
+        assert cache.open()[1][0, 0] == -2
+        # the ids and the features are swapped at once, in a single file
+        assert [k for k in os.listdir(directory) if k.startswith('cache')] == ['cache.npy']
+      finally:
+        shutil.rmtree(directory)
+
+    def test_driver_choices(self):
+      from .driver import CHOICES
+      from .models import class_choices
+      db = Database()
+      # the static choices of the command line match the database
+      assert CHOICES['purpose'] == db.purposes()
+      assert CHOICES['group'] == db.groups()
+      assert CHOICES['class'] == class_choices
+
+    def test_lazy_import(self):
+      import subprocess
+      if sys.version_info < (3, 7): return
+      code = "; ".join((
+        "import sys, time",
+        "start = time.time()",
+        "import xbob.db.biosecuridsigngf",
+        "package = time.time() - start",
+        "loaded = [k for k in ('sqlalchemy', 'numpy', 'xbob.db.verification.utils', 'xbob.db.biosecuridsigngf.query') if k in sys.modules]",
+        "start = time.time()",
+        "xbob.db.biosecuridsigngf.Database",
+        "database = time.time() - start",
+        "print('%f %f %s' % (package, database, ','.join(loaded)))",
+        ))
+      output = subprocess.check_output([sys.executable, '-c', code]).decode().split()
+      package, database = float(output[0]), float(output[1])
+      # importing the package does not load the database modules
+      assert len(output) == 2, "Modules loaded by the package import: %s" % output[2]
+      assert package < database, "Importing the package took %.3fs, the database %.3fs" % (package, database)
+
+    def test_driver_import(self):
+      import subprocess
+      code = "; ".join((
+        "import sys, argparse",
+        "from xbob.db.biosecuridsigngf.driver import Interface",
+        "before = set(sys.modules)",
+        "Interface().add_commands(argparse.ArgumentParser().add_subparsers())",
+        "loaded = [k for k in ('sqlalchemy', 'numpy', 'xbob.db.biosecuridsigngf.models', 'xbob.db.biosecuridsigngf.create', 'xbob.db.biosecuridsigngf.query') if k in set(sys.modules) - before]",
+        "print(','.join(loaded))",
+        ))
+      loaded = subprocess.check_output([sys.executable, '-c', code]).decode().strip()
+      # building the command line parser does not load the database modules
+      assert not loaded, "Modules loaded by the command line parser: %s" % loaded
+
+    def test_create(self):
+      import tempfile, shutil, sqlite3, argparse
+      from .create import create, parse_filename
+      from .models import Client
+      assert parse_filename('51_8_skilled') == (Client.make_id('skilled', 51), 2, 8)
+      assert parse_filename('51_8_skilled_copy') is None
+      directory = tempfile.mkdtemp()
+      try:
+        imagedir = os.path.join(directory, 'features')
+        os.makedirs(imagedir)
+        for name in ('1_1_genuine', '51_1_genuine', '51_8_genuine', '51_3_skilled', '351_1_genuine', '351_2_genuine'):
+          open(os.path.join(imagedir, name + '.txt'), 'w').close()
+        dbfile = os.path.join(directory, 'db', 'db.sql3')
+        create(argparse.Namespace(type='sqlite', files=[dbfile], imagedir=imagedir, recreate=True, update=False, verbose=0))
+        connection = sqlite3.connect(dbfile)
+        assert connection.execute('SELECT COUNT(*) FROM client').fetchone()[0] == 800
+        assert connection.execute('SELECT COUNT(*) FROM file').fetchone()[0] == 6
+        counts = dict(connection.execute("SELECT protocol.name || '/' || protocolPurpose.purpose, COUNT(*) "
+          'FROM protocolPurpose_file_association JOIN protocolPurpose ON protocolPurpose.id = protocolPurpose_id '
+          'JOIN protocol ON protocol.id = protocol_id GROUP BY protocol.name, protocolPurpose.purpose'))
+        connection.close()
+        assert counts == {'skilledImpostors/train': 1, 'skilledImpostors/enrol': 1, 'skilledImpostors/probe': 2,
+          'randomImpostors/train': 1, 'randomImpostors/enrol': 1, 'randomImpostors/probe': 2}
+
+        # incremental update
+        os.unlink(os.path.join(imagedir, '51_8_genuine.txt'))
+        open(os.path.join(imagedir, '52_2_genuine.txt'), 'w').close()
+        os.makedirs(os.path.join(imagedir, 'forgeries'))
+        open(os.path.join(imagedir, 'forgeries', '52_3_skilled.txt'), 'w').close()
+        create(argparse.Namespace(type='sqlite', files=[dbfile], imagedir=imagedir, recreate=False, update=True, verbose=0))
+        connection = sqlite3.connect(dbfile)
+        paths = set(k for (k,) in connection.execute('SELECT path FROM file'))
+        assert paths == set(('1_1_genuine', '51_1_genuine', '51_3_skilled', '351_1_genuine', '351_2_genuine', '52_2_genuine', 'forgeries/52_3_skilled'))
+        attached = connection.execute('SELECT COUNT(*) FROM protocolPurpose_file_association').fetchone()[0]
+        connection.close()
+        # one file less and two more enrolment files (one per protocol), one more skilled probe
+        assert attached == 8 - 2 + 2 + 1
+
+        # a failed build leaves no file behind
+        failed = os.path.join(directory, 'db', 'failed.sql3')
+        self.assertRaises(Exception, create, argparse.Namespace(type='sqlite', files=[failed],
+          imagedir=os.path.join(directory, 'missing'), recreate=False, update=False, verbose=0))
+        assert not os.path.exists(failed)
+
+        # an existing database is left alone, unless it is recreated or updated
+        assert create(argparse.Namespace(type='sqlite', files=[dbfile], imagedir=imagedir, recreate=False, update=False, verbose=0)) == 1
+        connection = sqlite3.connect(dbfile)
+        assert connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND name = 'ix_protocolPurpose_file_association_file'").fetchone()[0] == 1
+        connection.close()
+
+        # a removed subdirectory takes its files away
+        shutil.rmtree(os.path.join(imagedir, 'forgeries'))
+        create(argparse.Namespace(type='sqlite', files=[dbfile], imagedir=imagedir, recreate=False, update=True, verbose=0))
+        connection = sqlite3.connect(dbfile)
+        paths = set(k for (k,) in connection.execute('SELECT path FROM file'))
+        assert paths == set(('1_1_genuine', '51_1_genuine', '51_3_skilled', '351_1_genuine', '351_2_genuine', '52_2_genuine'))
+        assert connection.execute('SELECT COUNT(*) FROM protocolPurpose_file_association').fetchone()[0] == attached - 1
+        assert connection.execute("SELECT COUNT(*) FROM directory_manifest WHERE path = 'forgeries'").fetchone()[0] == 0
+        connection.close()
+      finally:
+        shutil.rmtree(directory)
+
+    def test_add_files_failure(self):
+      import tempfile, shutil, threading
+      from .create import add_files
+      class Failing(object):
+        def execute(self, *args):
+          raise RuntimeError('insert failed')
+      directory = tempfile.mkdtemp()
+      try:
+        for k in range(1, 11):
+          open(os.path.join(directory, '51_%d_genuine.txt' % k), 'w').close()
+        threads = threading.active_count()
+        self.assertRaises(RuntimeError, add_files, Failing(), directory, 0, batch_size=1, queue_size=1)
+        # the scanner does not stay blocked on the full queue
+        assert threading.active_count() == threads
+      finally:
+        shutil.rmtree(directory)
+
+    def test_query_plans(self):
+      import re
+      from .models import FileRecord
+      db = Database()
+      db.assert_validity()
+      cursor = db.m_session.connection().connection.cursor()
+      shapes = (
+        {'protocol': 'skilledImpostors', 'groups': 'eval', 'purposes': 'probe', 'model_ids': [1]},
+        {'protocol': 'randomImpostors', 'groups': 'eval', 'purposes': 'enrol', 'model_ids': [1, 2]},
+        {'protocol': 'randomImpostors', 'groups': 'eval', 'purposes': 'probe', 'classes': 'randomImpostor'},
+        )
+      for kwargs in shapes:
+        parameters = db.__objects_parameters__(kwargs.get('protocol'), kwargs.get('purposes'),
+            kwargs.get('model_ids'), kwargs.get('groups'), kwargs.get('classes'))
+        q = db.__objects_query__(FileRecord.columns(), *parameters)
+        # the IN lists are expanded in the SQL, as they are when the query runs
+        statement = q.statement.compile(dialect=db.m_session.bind.dialect,
+            compile_kwargs={'render_postcompile': True})
+        values = [statement.params[k] for k in statement.positiontup]
+        plan = [row[-1] for row in cursor.execute('EXPLAIN QUERY PLAN ' + str(statement), values)]
+        # the large tables are never scanned without an index
+        for detail in plan:
+          assert not re.match(r'^SCAN (TABLE )?(file|client|protocolPurpose_file_association)( AS \w+)?$', detail), \
+              "Full scan for %s: %s" % (kwargs, plan)
+
+    def test_client_ids(self):
+      from .models import Client
+      db = Database()
+      clients = db.clients()
+      # the integer ids follow the numeric order of the subjects
+      assert [c.id for c in clients] == sorted(c.id for c in clients)
+      assert [c.subid for c in clients if c.stype == 'genuine'] == sorted(c.subid for c in clients if c.stype == 'genuine')
+      assert db.client('genuine_51').id == Client.make_id('genuine', 51)
+      assert db.client(Client.make_id('skilled', 2)).name == 'skilled_2'
+      assert db.has_client_id('skilled_400')
+      assert not db.has_client_id('skilled_401')
+
+    def test_read_only(self):
+      if sys.version_info < (3, 4): return
+      db = Database(read_only=True)
+      assert [f.id for f in db.objects(protocol='skilledImpostors')] == \
+          [f.id for f in Database().objects(protocol='skilledImpostors')]
+      assert db.m_session.execute('PRAGMA mmap_size').scalar() == db.m_mmap_size
+      assert [f.id for f in db.objects(protocol='randomImpostors', model_ids=[3])] == \
+          [f.id for f in Database().objects(protocol='randomImpostors', model_ids=[3])]
+
+    def test_processes(self):
+      import pickle, multiprocessing
+      db = Database(read_only=sys.version_info >= (3, 4))
+      expected = len(db.objects(protocol='skilledImpostors', model_ids=[1]))
+      copy = pickle.loads(pickle.dumps(db))
+      assert copy.m_session is not db.m_session
+      assert len(copy.objects(protocol='skilledImpostors', model_ids=[1])) == expected
+      # the database is used by the parent and the children
+      pool = multiprocessing.Pool(2)
+      try:
+        counts = pool.map(_count_models, [(db, k) for k in (1, 2, 3, 4)])
+      finally:
+        pool.close()
+        pool.join()
+      assert counts == [expected] * 4
+      assert len(db.objects(protocol='skilledImpostors', model_ids=[1])) == expected
+
+    def test_cache(self):
+      from .cache import QueryCache
+      db = Database(cache=True)
+      files = db.objects(protocol='skilledImpostors', purposes=('probe', 'enrol'), lightweight=True)
+      assert isinstance(files, tuple)
+      # equivalent parameters share the same result
+      assert db.objects(protocol=('skilledImpostors',), purposes=('enrol', 'probe'), lightweight=True) is files
+      assert db.model_ids() is db.model_ids()
+      assert db.cache_info()['hits'] == 2
+      assert db.cache_info()['misses'] == 2
+      # the mapped objects are not cached
+      assert db.objects(protocol='skilledImpostors') is not db.objects(protocol='skilledImpostors')
+      assert db.cache_info()['misses'] == 2
+      # the cache is bounded and can be shared
+      cache = QueryCache(maxsize=1)
+      first, second = Database(cache=cache), Database(cache=cache)
+      clients = first.clients(lightweight=True)
+      assert second.clients(lightweight=True) is clients
+      second.models(lightweight=True)
+      assert cache.info()['size'] == 1
+      assert first.clients(lightweight=True) is not clients
+      assert Database().cache_info() is None
+      # a cache shared with a snapshot keeps the mapped objects apart
+      cache = QueryCache()
+      snap, db = Database(snapshot=True, cache=cache), Database(cache=cache)
+      from .models import File, FileRecord
+      assert isinstance(snap.objects(groups='eval')[0], FileRecord)
+      assert isinstance(db.objects(groups='eval')[0], File)
+
+    def test_batched_lookups(self):
+      db = Database()
+      db.lookup_chunk_size = 7
+      ids = [f.id for f in db.objects(protocol='skilledImpostors')][::-3][:50]
+      files = db.files(ids)
+      assert [f.id for f in files] == ids
+      paths = [f.path for f in files]
+      assert [f.id for f in db.reverse(paths)] == ids
+      assert [f.id for f in Database(snapshot=True).reverse(paths)] == ids
+      assert db.paths(ids, 'dir', '.txt') == [os.path.join('dir', p + '.txt') for p in paths]
+      # the misses are reported all at once, or skipped
+      try:
+        db.reverse(paths + ['missing_a', 'missing_b'])
+        assert False
+      except KeyError as e:
+        assert 'missing_a' in str(e) and 'missing_b' in str(e)
+      assert len(db.reverse(['missing_a'] + paths, ignore_missing=True)) == len(paths)
+      # the command line reads the ids from a file
+      import tempfile
+      from bob.db.script.dbmanage import main
+      with tempfile.NamedTemporaryFile('w', suffix='.lst', delete=False) as f:
+        f.write('\n'.join(str(k) for k in ids) + '\n')
+      try:
+        assert main(('biosecuridsigngf path -i %s --self-test' % f.name).split()) == 0
+      finally:
+        os.unlink(f.name)
+      # an unknown id is reported
+      stderr = sys.stderr
+      sys.stderr = six.StringIO()
+      try:
+        assert main('biosecuridsigngf path 999999 --self-test'.split()) == 1
+        assert '999999' in sys.stderr.getvalue()
+      finally:
+        sys.stderr = stderr
+
+    def test_object_rows(self):
+      db = Database()
+      files = db.objects(protocol='skilledImpostors', groups='eval')
+      rows = list(db.object_rows(protocol='skilledImpostors', groups='eval', batch_size=100))
+      assert [f.id for f, _, _, _ in rows] == [f.id for f in files]
+      for f, client, purpose, sclass in rows[:50]:
+        assert client == db.client(f.client_id).name
+        assert purpose in ('enrol', 'probe')
+        assert (sclass is None) == (purpose == 'enrol')
+      from bob.db.script.dbmanage import main
+      for format in ('lines', 'null', 'jsonl', 'csv'):
+        assert main(('biosecuridsigngf dumplist --format=%s --batch-size=10 --self-test' % format).split()) == 0
+
+    def test_shards(self):
+      db = Database()
+      snap = Database(snapshot=True)
+      kwargs = {'protocol': 'skilledImpostors', 'groups': 'eval'}
+      ids = [f.id for f in db.objects(**kwargs)]
+      for shard_by in ('file', 'client'):
+        shards = [[f.id for f in db.objects(shard='%d/3' % k, shard_by=shard_by, **kwargs)] for k in (1, 2, 3)]
+        assert sorted(sum(shards, [])) == sorted(ids)
+        assert [f.id for f in snap.objects(shard=(2, 3), shard_by=shard_by, **kwargs)] == shards[1]
+      # the random impostor probes are in every shard by client
+      random = set(f.id for f in db.objects(protocol='randomImpostors', purposes='probe', classes='randomImpostor'))
+      for k in (1, 2, 3):
+        shard = set(f.id for f in db.objects(protocol='randomImpostors', shard=(k, 3), shard_by='client'))
+        assert random <= shard
+        assert random <= set(f.id for f in snap.objects(protocol='randomImpostors', shard=(k, 3), shard_by='client'))
+      # all files of a model are in the same shard
+      subids = [set(db.client(f.client_id).subid for f in db.objects(shard=(k, 4), shard_by='client', **kwargs)) for k in (1, 2, 3, 4)]
+      assert sum(len(s) for s in subids) == len(set.union(*subids))
+      self.assertRaises(ValueError, db.objects, shard='0/3')
+      self.assertRaises(ValueError, db.objects, shard='1-3')
+      from bob.db.script.dbmanage import main
+      assert main('biosecuridsigngf dumplist --shard=2/5 --shard-by=client --self-test'.split()) == 0
+
+    def test_iter_objects(self):
+      db = Database()
+      for kwargs in ({}, {'protocol': 'randomImpostors', 'purposes': 'probe'}, {'groups': 'eval', 'shard': '1/2'}):
+        ids = [f.id for f in db.objects(**kwargs)]
+        assert [f.id for f in db.iter_objects(batch_size=50, **kwargs)] == ids
+        assert [f.id for f in db.iter_objects(lightweight=True, **kwargs)] == ids
+        assert [f.id for f in Database(snapshot=True).iter_objects(**kwargs)] == ids
+      files = db.iter_objects(protocol='skilledImpostors')
+      assert next(files).id == db.objects(protocol='skilledImpostors')[0].id
+
+    def test_async(self):
+      if sys.version_info < (3, 7): return
+      import asyncio
+      from . import AsyncDatabase
+      from .models import FileRecord, ClientRecord
+      db = Database()
+      adb = AsyncDatabase(workers=2)
+      async_loop = asyncio.new_event_loop()
+      def submit(*calls):
+        # the queries are submitted from the running loop
+        futures = []
+        async_loop.call_soon(lambda: futures.extend(k() for k in calls))
+        async_loop.run_until_complete(asyncio.sleep(0))
+        return futures
+      gather = lambda *calls: async_loop.run_until_complete(asyncio.gather(*submit(*calls)))
+      try:
+        files, model_ids, client = gather(lambda: adb.objects(protocol='skilledImpostors'),
+            adb.model_ids, lambda: adb.client(db.objects()[0].client_id))
+        assert [f.id for f in files] == [f.id for f in db.objects(protocol='skilledImpostors')]
+        assert list(model_ids) == db.model_ids()
+        assert client.id == db.objects()[0].client_id
+        # no mapped object leaves the thread which queried it
+        assert isinstance(files[0], FileRecord) and isinstance(client, ClientRecord)
+        paths, = gather(lambda: adb.paths([f.id for f in files[:10]]))
+        reversed_files, = gather(lambda: adb.reverse(paths))
+        assert [f.id for f in reversed_files] == [f.id for f in files[:10]]
+        assert isinstance(reversed_files[0], FileRecord)
+        # the threads share the same cache
+        gather(*[adb.model_ids for k in range(4)])
+        assert adb.m_kwargs['cache'].info()['hits'] >= 4
+        # a cancelled query does not break the next ones
+        future, = submit(adb.objects)
+        future.cancel()
+        assert len(gather(adb.objects)[0]) == len(db.objects())
+      finally:
+        adb.close()
+        async_loop.close()